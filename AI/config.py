@@ -39,13 +39,25 @@ CONFIG = {
             },
             "connect_timeout_sec": 5,
             "request_timeout_sec": 120,
+            # максимум одновременных запросов к GigaChat (1 — строго последовательно)
+            "max_concurrency": 4,
             # отключить preflight GET /models (если сервер требует другую цепочку CA)
             "enable_preflight_models": False
+        },
+        # Self-consistency: параллельная генерация k кандидатов с досрочной остановкой,
+        # когда quorum распарсенных кандидатов совпал по verdict (по умолчанию — большинство из k)
+        "self_consistency": {
+            "parallel": True,
+            "quorum": 2
         }
     },
     "default_params": {
         "step": "1m",
-        "resample_interval": "10T"
+        "resample_interval": "10T",
+        # максимум одновременных PromQL-запросов (все запросы всех доменов выполняются одним пакетом)
+        "max_in_flight": 8,
+        # формат таблиц доменов на странице: "markdown" или "storage" (таблицы Confluence Storage)
+        "tables_format": "markdown"
     },
     # Источник метрик: напрямую из Prometheus или через Grafana proxy (без прямого доступа к Prometheus)
     "metrics_source": {
@@ -63,7 +75,9 @@ CONFIG = {
             "prometheus_datasource": {
                 "id": None,
                 "uid": "",
-                "name": ""
+                "name": "",
+                # сколько секунд хранить разрешённый по uid/name id (сброс также при 404)
+                "cache_ttl_sec": 3600
             }
         }
     },
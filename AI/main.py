@@ -1,8 +1,7 @@
 # main.py
 
-import requests
 import pandas as pd
-from typing import List, Dict, Optional, Union
+from typing import Callable, List, Dict, Optional, Union
 import json
 import os
 from datetime import datetime
@@ -11,7 +10,11 @@ import threading
 import socket
 import time
 import re
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
 
 from langchain_gigachat.chat_models import GigaChat as LC_GigaChat
 from pydantic import BaseModel, Field, ValidationError, root_validator
@@ -27,10 +30,19 @@ except Exception:
 
 # Импортируем CONFIG из config.py
 from AI.config import CONFIG
+from utils import http_client
+from confluence_manager.storage_table import render_table
 
 logger = logging.getLogger(__name__)
-_gigachat_lock = threading.Lock()
+# Ограничение числа одновременных запросов к GigaChat (1 — строго последовательный режим)
+_gigachat_max_concurrency = max(1, int(CONFIG.get("llm", {}).get("gigachat", {}).get("max_concurrency", 4)))
+_gigachat_semaphore = threading.BoundedSemaphore(_gigachat_max_concurrency)
+# Защищает ленивую инициализацию клиента, окружения и префлайта
+_gigachat_init_lock = threading.Lock()
 _gigachat_client = None
+# Кэш id Prometheus-датасорса в Grafana: (base_url, способ, значение) -> (id, время разрешения)
+_grafana_ds_cache: Dict[tuple, tuple[int, float]] = {}
+_grafana_ds_cache_lock = threading.Lock()
 _gigachat_env_applied = False
 _gigachat_preflight_last_ts = 0.0
 
@@ -121,7 +133,7 @@ def _gigachat_preflight(gcfg: dict) -> None:
             logger.warning("mTLS включён, но cert/key файл(ы) не найдены. Пропускаю клиентский сертификат.")
 
     try:
-        resp = requests.get(
+        resp = http_client.get(
             models_url,
             headers={"Accept": "application/json"},
             timeout=timeout,
@@ -179,12 +191,51 @@ def fetch_prometheus_data(
     }
 
     url = f'{prometheus_url}/api/v1/query_range'
-    resp = requests.get(url, params=params, timeout=30)
+    resp = http_client.get(url, params=params, timeout=30)
     resp.raise_for_status()
     return resp.json()
 
 
+def _grafana_ds_cache_key(g_cfg: dict) -> tuple:
+    base_url = g_cfg["base_url"].rstrip("/")
+    ds_cfg = g_cfg.get("prometheus_datasource", {})
+    if ds_cfg.get("uid"):
+        return (base_url, "uid", ds_cfg["uid"])
+    if ds_cfg.get("name"):
+        return (base_url, "name", ds_cfg["name"])
+    return (base_url, "type", "prometheus")
+
+
+def invalidate_grafana_ds_cache(g_cfg: Optional[dict] = None) -> None:
+    """Сбрасывает кэш id датасорса: для указанной конфигурации или целиком."""
+    with _grafana_ds_cache_lock:
+        if g_cfg is None:
+            _grafana_ds_cache.clear()
+        else:
+            _grafana_ds_cache.pop(_grafana_ds_cache_key(g_cfg), None)
+
+
 def _resolve_grafana_prom_ds_id(g_cfg: dict) -> int:
+    """Возвращает id Prometheus-датасорса. Разрешение по uid/name/списку выполняется
+    один раз на процесс и кэшируется на prometheus_datasource.cache_ttl_sec секунд."""
+    ds_cfg = g_cfg.get("prometheus_datasource", {})
+    if isinstance(ds_cfg.get("id"), int):
+        return ds_cfg["id"]
+
+    key = _grafana_ds_cache_key(g_cfg)
+    ttl = float(ds_cfg.get("cache_ttl_sec", 3600))
+    # Разрешение под блокировкой: параллельные запросы ждут один HTTP-вызов вместо N одинаковых
+    with _grafana_ds_cache_lock:
+        cached = _grafana_ds_cache.get(key)
+        if cached is not None and time.time() - cached[1] < ttl:
+            return cached[0]
+        ds_id = _lookup_grafana_prom_ds_id(g_cfg)
+        _grafana_ds_cache[key] = (ds_id, time.time())
+        logger.info(f"Grafana datasource id resolved: {ds_id} ({key[1]}={key[2]})")
+        return ds_id
+
+
+def _lookup_grafana_prom_ds_id(g_cfg: dict) -> int:
     base_url = g_cfg["base_url"].rstrip("/")
     ds_cfg = g_cfg.get("prometheus_datasource", {})
     auth_cfg = g_cfg.get("auth", {})
@@ -205,18 +256,18 @@ def _resolve_grafana_prom_ds_id(g_cfg: dict) -> int:
 
     if ds_cfg.get("uid"):
         url = f"{base_url}/api/datasources/uid/{ds_cfg['uid']}"
-        resp = requests.get(url, headers=headers, auth=auth, timeout=30, verify=verify)
+        resp = http_client.get(url, headers=headers, auth=auth, timeout=30, verify=verify)
         resp.raise_for_status()
         return resp.json()["id"]
 
     if ds_cfg.get("name"):
         url = f"{base_url}/api/datasources/name/{ds_cfg['name']}"
-        resp = requests.get(url, headers=headers, auth=auth, timeout=30, verify=verify)
+        resp = http_client.get(url, headers=headers, auth=auth, timeout=30, verify=verify)
         resp.raise_for_status()
         return resp.json()["id"]
 
     url = f"{base_url}/api/datasources"
-    resp = requests.get(url, headers=headers, auth=auth, timeout=30, verify=verify)
+    resp = http_client.get(url, headers=headers, auth=auth, timeout=30, verify=verify)
     resp.raise_for_status()
     for ds in resp.json():
         if ds.get("type") == "prometheus":
@@ -253,7 +304,14 @@ def fetch_prometheus_data_via_grafana(
         auth = (auth_cfg.get("username"), auth_cfg.get("password"))
 
     url = f"{base_url}/api/datasources/proxy/{ds_id}/api/v1/query_range"
-    resp = requests.get(url, headers=headers, auth=auth, params=params, timeout=30, verify=g_cfg.get("verify_ssl", True))
+    resp = http_client.get(url, headers=headers, auth=auth, params=params, timeout=30, verify=g_cfg.get("verify_ssl", True))
+    if resp.status_code == 404 and not isinstance(g_cfg.get("prometheus_datasource", {}).get("id"), int):
+        # Датасорс мог быть пересоздан с новым id: сбрасываем кэш и повторяем один раз
+        logger.warning(f"Grafana datasource id {ds_id} returned 404, re-resolving")
+        invalidate_grafana_ds_cache(g_cfg)
+        ds_id = _resolve_grafana_prom_ds_id(g_cfg)
+        url = f"{base_url}/api/datasources/proxy/{ds_id}/api/v1/query_range"
+        resp = http_client.get(url, headers=headers, auth=auth, params=params, timeout=30, verify=g_cfg.get("verify_ssl", True))
     resp.raise_for_status()
     return resp.json()
 
@@ -273,6 +331,79 @@ def fetch_metric_series(
         return fetch_prometheus_data(prometheus_url, start_ts, end_ts, promql_query, step)
 
 
+def fetch_metric_series_many(
+    prometheus_url: str,
+    start_ts: float,
+    end_ts: float,
+    promql_queries: List[str],
+    step: str,
+    max_in_flight: Optional[int] = None,
+    return_exceptions: bool = False
+) -> List[Union[dict, Exception]]:
+    """
+    Выполняет PromQL-запросы параллельно (не более max_in_flight одновременно).
+    Результаты возвращаются в порядке promql_queries. При return_exceptions=True
+    ошибка отдельного запроса возвращается на его позиции вместо исключения.
+    """
+    if not promql_queries:
+        return []
+    if max_in_flight is None:
+        max_in_flight = CONFIG.get("default_params", {}).get("max_in_flight", 8)
+    workers = max(1, min(int(max_in_flight), len(promql_queries)))
+
+    def _fetch(query: str) -> Union[dict, Exception]:
+        try:
+            return fetch_metric_series(prometheus_url, start_ts, end_ts, query, step)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="promql") as executor:
+        return list(executor.map(_fetch, promql_queries))
+
+
+def _series_json_to_dataframe(
+    data_json: dict,
+    keys_for_this_query: List[str],
+    resample_interval: str
+) -> pd.DataFrame:
+    """Преобразует ответ query_range в pivot DataFrame (время × серии) с ресемплированием."""
+    records = []
+    if data_json.get("status") == "success":
+        result = data_json["data"].get("result", [])
+        for series in result:
+            lbls = series.get("metric", {})
+
+            label_parts = []
+            for key in keys_for_this_query:
+                val = lbls.get(key, "unknown")
+                label_parts.append(f"{key}={val}")
+            label_str = "|".join(label_parts)
+
+            for (ts_float, value_str) in series["values"]:
+                val = float(value_str)
+                records.append([ts_float, label_str, val])
+
+    if not records:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(records, columns=["timestamp", "label", "value"])
+    df["time"] = pd.to_datetime(df["timestamp"], unit='s')
+    df['time'] = df['time'].dt.tz_localize('UTC').dt.tz_convert('Etc/GMT-3')
+    df.set_index("time", inplace=True)
+    df.drop(columns=["timestamp"], inplace=True)
+
+    pivoted = df.pivot_table(
+        index=df.index,
+        columns="label",
+        values="value",
+        aggfunc="sum"
+    )
+
+    return pivoted.resample(resample_interval).mean()
+
+
 def fetch_and_aggregate_with_label_keys(
     prometheus_url: str,
     start_ts: float,
@@ -280,60 +411,59 @@ def fetch_and_aggregate_with_label_keys(
     promql_queries: List[str],
     label_keys_list: List[List[str]],
     step: str,
-    resample_interval: str
+    resample_interval: str,
+    prefetched: Optional[List[dict]] = None
 ) -> List[pd.DataFrame]:
+    """
+    Возвращает по DataFrame на каждый запрос (порядок совпадает с promql_queries).
+    prefetched — уже полученные ответы query_range (например, общий параллельный
+    запрос по всем доменам); если не переданы, запросы выполняются параллельно здесь.
+    """
     if len(promql_queries) != len(label_keys_list):
         raise ValueError(
             "Количество запросов (promql_queries) и количество списков лейблов (label_keys_list) не совпадает!"
         )
 
-    dfs = []
-    for query, keys_for_this_query in zip(promql_queries, label_keys_list):
-        data_json = fetch_metric_series(
-            prometheus_url,
-            start_ts,
-            end_ts,
-            query,
-            step
-        )
-
-        records = []
-        if data_json.get("status") == "success":
-            result = data_json["data"].get("result", [])
-            for series in result:
-                lbls = series.get("metric", {})
-
-                label_parts = []
-                for key in keys_for_this_query:
-                    val = lbls.get(key, "unknown")
-                    label_parts.append(f"{key}={val}")
-                label_str = "|".join(label_parts)
+    if prefetched is None:
+        prefetched = fetch_metric_series_many(prometheus_url, start_ts, end_ts, promql_queries, step)
+    elif len(prefetched) != len(promql_queries):
+        raise ValueError("Количество полученных ответов не совпадает с количеством запросов (promql_queries)!")
 
-                for (ts_float, value_str) in series["values"]:
-                    val = float(value_str)
-                    records.append([ts_float, label_str, val])
-
-        if not records:
-            dfs.append(pd.DataFrame())
-            continue
+    dfs = []
+    for data_json, keys_for_this_query in zip(prefetched, label_keys_list):
+        dfs.append(_series_json_to_dataframe(data_json, keys_for_this_query, resample_interval))
 
-        df = pd.DataFrame(records, columns=["timestamp", "label", "value"])
-        df["time"] = pd.to_datetime(df["timestamp"], unit='s')
-        df['time'] = df['time'].dt.tz_localize('UTC').dt.tz_convert('Etc/GMT-3')
-        df.set_index("time", inplace=True)
-        df.drop(columns=["timestamp"], inplace=True)
-
-        pivoted = df.pivot_table(
-            index=df.index,
-            columns="label",
-            values="value",
-            aggfunc="sum"
-        )
+    return dfs
 
-        pivoted_resampled = pivoted.resample(resample_interval).mean()
-        dfs.append(pivoted_resampled)
 
-    return dfs
+def _top_mean_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Оставляет до 10 столбцов: числовые по убыванию среднего, затем нечисловые."""
+    if df.empty or df.shape[0] == 0:
+        return df
+    numeric_columns = df.select_dtypes(include=['number']).columns
+    if len(numeric_columns) > 0:
+        column_means = df[numeric_columns].mean()
+        sorted_numeric_columns = column_means.sort_values(ascending=False).index.tolist()
+        non_numeric_columns = [col for col in df.columns if col not in numeric_columns]
+        sorted_columns = sorted_numeric_columns + non_numeric_columns
+    else:
+        sorted_columns = df.columns.tolist()
+    top_columns = sorted_columns[:min(10, len(sorted_columns))]
+    return df[top_columns]
+
+
+def _format_numeric_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Форматирует числовые столбцы в строки по величине значений: от 1e6 — целые, от 1000 — один знак, иначе — четыре."""
+    df = df.copy()
+    for col in df.select_dtypes(include=['number']).columns:
+        max_val = df[col].abs().max()
+        if max_val >= 1e6:
+            df[col] = df[col].apply(lambda x: f"{int(x):,}" if pd.notnull(x) else "")
+        elif max_val >= 1000:
+            df[col] = df[col].apply(lambda x: f"{x:,.1f}" if pd.notnull(x) else "")
+        else:
+            df[col] = df[col].apply(lambda x: f"{x:.4f}" if pd.notnull(x) else "")
+    return df
 
 
 def dataframes_to_markdown(labeled_dfs: List[Dict[str, object]]) -> str:
@@ -344,26 +474,10 @@ def dataframes_to_markdown(labeled_dfs: List[Dict[str, object]]) -> str:
         result.append(f"## {label}\n")
         result.append("### Топ-10 сервисов по среднему значению\n")
         if not df.empty and df.shape[0] > 0:
-            numeric_columns = df.select_dtypes(include=['number']).columns
-            if len(numeric_columns) > 0:
-                column_means = df[numeric_columns].mean()
-                sorted_numeric_columns = column_means.sort_values(ascending=False).index.tolist()
-                non_numeric_columns = [col for col in df.columns if col not in numeric_columns]
-                sorted_columns = sorted_numeric_columns + non_numeric_columns
-            else:
-                sorted_columns = df.columns.tolist()
-            top_columns = sorted_columns[:min(10, len(sorted_columns))]
-            df = df[top_columns]
+            df = _top_mean_columns(df)
             for col in df.select_dtypes(include=['object']).columns:
                 df[col] = df[col].astype(str).str.replace('|', '/')
-            for col in df.select_dtypes(include=['number']).columns:
-                max_val = df[col].abs().max()
-                if max_val >= 1e6:
-                    df[col] = df[col].apply(lambda x: f"{int(x):,}" if pd.notnull(x) else "")
-                elif max_val >= 1000:
-                    df[col] = df[col].apply(lambda x: f"{x:,.1f}" if pd.notnull(x) else "")
-                else:
-                    df[col] = df[col].apply(lambda x: f"{x:.4f}" if pd.notnull(x) else "")
+            df = _format_numeric_columns(df)
         df_transposed = df.T
         df_transposed.index = df_transposed.index.map(lambda x: str(x).replace('|', '/'))
         if hasattr(df_transposed, 'columns'):
@@ -372,6 +486,27 @@ def dataframes_to_markdown(labeled_dfs: List[Dict[str, object]]) -> str:
     return "\n".join(result)
 
 
+def dataframes_to_storage(labeled_dfs: List[Dict[str, object]]) -> str:
+    """
+    То же, что dataframes_to_markdown, но таблицы формируются сразу в Confluence Storage
+    (confluence_manager.storage_table), значения и заголовки экранируются.
+    """
+    result = []
+    for item in labeled_dfs:
+        label = item['label']
+        df = item['df']
+        result.append(f"<h2>{xml_escape(str(label))}</h2>")
+        result.append("<h3>Топ-10 сервисов по среднему значению</h3>")
+        if not df.empty and df.shape[0] > 0:
+            df = _format_numeric_columns(_top_mean_columns(df))
+        # Сервисы — строки, моменты времени — столбцы (как в markdown-варианте)
+        df_transposed = df.T
+        df_transposed.index = df_transposed.index.map(str)
+        df_transposed.columns = df_transposed.columns.map(str)
+        result.append(render_table(df_transposed, index=True))
+    return "".join(result)
+
+
 def _summarize_time_series_dataframe(df: pd.DataFrame, top_n: int = 10) -> List[Dict[str, object]]:
     """Возвращает компактное резюме по колонкам (сериям) DataFrame:
     - series: имя серии (лейблы)
@@ -595,8 +730,13 @@ def _build_domain_data(
     end_ts: float,
     step: str,
     resample: str,
-    top_n: int
+    top_n: int,
+    prefetched: Optional[List[Union[dict, Exception]]] = None
 ) -> Dict[str, object]:
+    # Ошибка любого запроса домена делает домен пустым (как и при последовательной выборке)
+    for item in (prefetched or []):
+        if isinstance(item, Exception):
+            raise item
     dfs = fetch_and_aggregate_with_label_keys(
         prometheus_url,
         start_ts,
@@ -604,10 +744,15 @@ def _build_domain_data(
         domain_conf["promql_queries"],
         domain_conf["label_keys_list"],
         step=step,
-        resample_interval=resample
+        resample_interval=resample,
+        prefetched=prefetched
     )
     labeled = label_dataframes(dfs, domain_conf["labels"])
-    markdown = dataframes_to_markdown(labeled)
+    # Таблицы для страницы: markdown (по умолчанию) или сразу Confluence Storage
+    if CONFIG.get("default_params", {}).get("tables_format", "markdown") == "storage":
+        markdown = dataframes_to_storage(labeled)
+    else:
+        markdown = dataframes_to_markdown(labeled)
     pack = build_context_pack(labeled, top_n=top_n)
     ctx = json.dumps({
         "domain": domain_key,
@@ -645,7 +790,6 @@ def _choose_best_candidate(candidates: list) -> tuple[str, Optional[LLMAnalysis]
     if not candidates:
         return "", None
     # Счётчик по verdict
-    from collections import Counter
     parsed_list = [p for (_, p) in candidates if p is not None]
     if not parsed_list:
         return candidates[0]
@@ -765,27 +909,87 @@ def _format_parsed_as_text(p: LLMAnalysis) -> str:
     return "\n".join(parts)
 
 
+def _generate_candidate(user_prompt: str, data_context: str,
+                        cancel_event: Optional[threading.Event] = None) -> tuple[str, Optional[LLMAnalysis]]:
+    """Один кандидат self-consistency: генерация и, при неудачном парсинге, исправление критиком.
+    При установленном cancel_event (кворум достигнут) новые запросы к GigaChat не отправляются — LLMCancelled."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise LLMCancelled()
+    raw = ask_llm_with_text_data(user_prompt=user_prompt, data_context=data_context, cancel_event=cancel_event)
+    parsed = parse_llm_analysis_strict(raw)
+    if parsed is None:
+        if cancel_event is not None and cancel_event.is_set():
+            raise LLMCancelled()
+        # Критик с попыткой нормализовать
+        critic_prompt = _build_critic_prompt(raw)
+        crit = ask_llm_with_text_data(user_prompt=critic_prompt, data_context=data_context, cancel_event=cancel_event)
+        parsed = parse_llm_analysis_strict(crit)
+        if parsed is None:
+            return raw, None
+    json_text = json.dumps(parsed.dict(), ensure_ascii=False, indent=2)
+    return json_text, parsed
+
+
 def llm_two_pass_self_consistency(user_prompt: str, data_context: str, k: int = 3) -> tuple[str, Optional[LLMAnalysis]]:
     """Двухпроходный режим: генерируем k кандидатов, критик исправляет до строгого JSON, выбираем лучший.
+    Кандидаты (вместе с исправлениями критика) генерируются параллельно; генерация прекращается досрочно,
+    как только кворум распарсенных кандидатов (llm.self_consistency.quorum) совпал по verdict.
     Возвращает (best_text, best_parsed). Текст — отформатированный JSON.
     """
+    k = max(1, int(k))
+    sc_cfg = CONFIG.get("llm", {}).get("self_consistency", {}) or {}
+    parallel = bool(sc_cfg.get("parallel", True))
+    quorum = int(sc_cfg.get("quorum") or (k // 2 + 1))
+
     candidates: list[tuple[str, Optional[LLMAnalysis]]] = []
-    for _ in range(max(1, int(k))):
-        raw = ask_llm_with_text_data(user_prompt=user_prompt, data_context=data_context)
-        parsed = parse_llm_analysis_strict(raw)
-        if parsed is None:
-            # Критик с попыткой нормализовать
-            critic_prompt = _build_critic_prompt(raw)
-            crit = ask_llm_with_text_data(user_prompt=critic_prompt, data_context=data_context)
-            parsed = parse_llm_analysis_strict(crit)
-            if parsed is not None:
-                json_text = json.dumps(parsed.dict(), ensure_ascii=False, indent=2)
-                candidates.append((json_text, parsed))
-            else:
-                candidates.append((raw, None))
-        else:
-            json_text = json.dumps(parsed.dict(), ensure_ascii=False, indent=2)
-            candidates.append((json_text, parsed))
+    verdict_votes: Counter = Counter()
+
+    def _accept(candidate: tuple[str, Optional[LLMAnalysis]]) -> bool:
+        """Добавляет кандидата и возвращает True, если кворум по verdict достигнут."""
+        candidates.append(candidate)
+        parsed = candidate[1]
+        if parsed is not None and parsed.verdict:
+            verdict_votes[parsed.verdict] += 1
+            return verdict_votes[parsed.verdict] >= quorum
+        return False
+
+    # Ошибки отдельных кандидатов в обоих режимах логируются и пропускаются;
+    # исключение пробрасывается, только если не получено ни одного кандидата
+    last_err = None
+    if not parallel or k == 1:
+        for _ in range(k):
+            try:
+                candidate = _generate_candidate(user_prompt, data_context)
+            except Exception as e:
+                last_err = e
+                logger.warning(f"LLM candidate generation failed: {e}")
+                continue
+            if _accept(candidate):
+                break
+    else:
+        # Кворум достигнут — оставшиеся кандидаты не отправляют новых запросов и не занимают слоты GigaChat
+        quorum_reached = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=k, thread_name_prefix="llm-candidate")
+        try:
+            futures = [executor.submit(_generate_candidate, user_prompt, data_context, quorum_reached) for _ in range(k)]
+            for future in as_completed(futures):
+                try:
+                    candidate = future.result()
+                except LLMCancelled:
+                    continue
+                except Exception as e:
+                    last_err = e
+                    logger.warning(f"LLM candidate generation failed: {e}")
+                    continue
+                if _accept(candidate):
+                    logger.info(f"Self-consistency quorum reached after {len(candidates)}/{k} candidates")
+                    break
+        finally:
+            # Уже отправленные в GigaChat запросы не прерываются, но новые (включая критика) не начинаются
+            quorum_reached.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+    if not candidates and last_err is not None:
+        raise last_err
 
     best_text, best_parsed = _choose_best_candidate(candidates)
     # Если лучший без парсинга — сделаем мягкий фолбэк текстом без изменения
@@ -816,6 +1020,13 @@ def label_dataframes(
 
 
 def _get_gigachat_client() -> LC_GigaChat:
+    if _gigachat_client is not None:
+        return _gigachat_client
+    with _gigachat_init_lock:
+        return _create_gigachat_client()
+
+
+def _create_gigachat_client() -> LC_GigaChat:
     global _gigachat_client
     if _gigachat_client is not None:
         return _gigachat_client
@@ -868,30 +1079,58 @@ Debug: %s
     return _gigachat_client
 
 
+class LLMCancelled(Exception):
+    """Запрос к LLM отменен до отправки (например, кворум self-consistency уже достигнут)."""
+
+
+@contextmanager
+def _gigachat_slot(cancel_event: Optional[threading.Event] = None):
+    """
+    Занимает слот _gigachat_semaphore. Если задан cancel_event, ожидание слота прерывается
+    при его установке (LLMCancelled), и отмененный запрос не занимает слот у других доменов.
+    """
+    if cancel_event is None:
+        _gigachat_semaphore.acquire()
+    else:
+        while not _gigachat_semaphore.acquire(timeout=0.2):
+            if cancel_event.is_set():
+                raise LLMCancelled()
+        if cancel_event.is_set():
+            _gigachat_semaphore.release()
+            raise LLMCancelled()
+    try:
+        yield
+    finally:
+        _gigachat_semaphore.release()
+
+
 def ask_llm_with_text_data(
     user_prompt: str,
     data_context: str,
     llm_config: dict = None,
     api_key: str = None,
     model: str = None,
-    base_url: str = None
+    base_url: str = None,
+    cancel_event: Optional[threading.Event] = None
 ) -> str:
     """
     Отправляет запрос к GigaChat (через langchain_gigachat) с подготовленными текстовыми данными.
+    Если cancel_event установлен до получения слота GigaChat, запрос не отправляется (LLMCancelled).
     """
     gcfg = CONFIG.get("llm", {}).get("gigachat", {})
     global _gigachat_env_applied, _gigachat_preflight_last_ts
-    # Кэшируем применение окружения на процесс
-    if not _gigachat_env_applied:
-        _ensure_gigachat_env(gcfg)
-        _gigachat_env_applied = True
-    # Префлайт выполняем не чаще, чем раз в 10 минут
-    now_ts = time.time()
-    if now_ts - _gigachat_preflight_last_ts > 600:
-        try:
-            _gigachat_preflight(gcfg)
-        finally:
-            _gigachat_preflight_last_ts = now_ts
+    with _gigachat_init_lock:
+        # Кэшируем применение окружения на процесс
+        if not _gigachat_env_applied:
+            _ensure_gigachat_env(gcfg)
+            _gigachat_env_applied = True
+        # Префлайт выполняем не чаще, чем раз в 10 минут
+        now_ts = time.time()
+        if now_ts - _gigachat_preflight_last_ts > 600:
+            try:
+                _gigachat_preflight(gcfg)
+            finally:
+                _gigachat_preflight_last_ts = now_ts
 
     gen = (CONFIG.get("llm", {}).get("gigachat", {}).get("generation") or {})
     # Можно переопределить требование JSON на уровне вызова (для overall)
@@ -914,7 +1153,7 @@ def ask_llm_with_text_data(
     )
     if SystemMessage and HumanMessage:
         lc_messages = [SystemMessage(content=system_text), HumanMessage(content=user_prompt + f"\n\n{data_context}")]
-        with _gigachat_lock:
+        with _gigachat_slot(cancel_event):
             # простые ретраи при read timeout
             attempts = 0
             last_err = None
@@ -933,7 +1172,7 @@ def ask_llm_with_text_data(
             return getattr(result, "content", str(result))
     else:
         # Fallback: одним запросом
-        with _gigachat_lock:
+        with _gigachat_slot(cancel_event):
             attempts = 0
             last_err = None
             while attempts < 3:
@@ -956,8 +1195,53 @@ def read_prompt_from_file(filename: str) -> str:
         return f.read()
 
 
-def uploadFromLLM(start_ts: float, end_ts: float) -> Dict[str, object]:
+def _log_metrics_to_labeled(log_metrics: List[Dict[str, object]], resample_interval: str) -> List[Dict[str, object]]:
+    """Ряды метрических запросов Loki (loki_collector.fetch_loki_log_metrics) -> список {label, df}
+    в формате label_dataframes."""
+    labeled = []
+    for item in log_metrics:
+        series = item.get("series") or []
+        keys = sorted({key for s in series for key in s.get("labels", {})})
+        data_json = {
+            "status": "success",
+            "data": {"result": [{"metric": s.get("labels", {}), "values": s.get("values", [])} for s in series]}
+        }
+        labeled.append({
+            "label": f"Логи {item.get('label')}: строк за {item.get('step')}",
+            "df": _series_json_to_dataframe(data_json, keys, resample_interval)
+        })
+    return labeled
+
+
+def uploadFromLLM(
+    start_ts: float,
+    end_ts: float,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    log_metrics: Optional[Union[List[Dict[str, object]], Callable[[], List[Dict[str, object]]]]] = None
+) -> Dict[str, object]:
+    """Доменный анализ (jvm, database, kafka, microservices) и общий итог.
+    progress_callback(done, total) вызывается после каждого LLM-анализа (4 домена + итог).
+    log_metrics — ряды числа строк логов по группам (метрические запросы Loki, элементы
+    {label, step, series}) или функция без аргументов, возвращающая их; функция вызывается
+    только при сборке контекста, поэтому запросы Loki идут параллельно с выгрузкой Prometheus.
+    Ряды попадают в контекст микросервисов и общего итога.
+    """
     _configure_logging()
+    llm_total = 5
+    llm_done = 0
+    progress_lock = threading.Lock()
+
+    def _report_progress() -> None:
+        nonlocal llm_done
+        with progress_lock:
+            llm_done += 1
+            done = llm_done
+        if progress_callback is not None:
+            try:
+                progress_callback(done, llm_total)
+            except Exception as e:
+                logger.warning(f"progress_callback failed: {e}")
+
     prometheus_url = CONFIG["prometheus"]["url"]
     src_type = (CONFIG.get("metrics_source", {}).get("type") or "prometheus").lower()
     if src_type == "grafana_proxy":
@@ -971,9 +1255,23 @@ def uploadFromLLM(start_ts: float, end_ts: float) -> Dict[str, object]:
 
     queries = CONFIG["queries"]
     domain_keys = ["jvm", "database", "kafka", "microservices"]
+
+    # Все PromQL-запросы всех доменов выполняются одним параллельным пакетом,
+    # затем ответы раскладываются по доменам в исходном порядке
+    all_queries: List[str] = []
+    domain_slices: Dict[str, tuple[int, int]] = {}
+    for key in domain_keys:
+        domain_queries = (queries.get(key) or {}).get("promql_queries", [])
+        domain_slices[key] = (len(all_queries), len(all_queries) + len(domain_queries))
+        all_queries.extend(domain_queries)
+    fetch_started = time.perf_counter()
+    all_series = fetch_metric_series_many(prometheus_url, start_ts, end_ts, all_queries, step, return_exceptions=True)
+    logger.info(f"Fetched {len(all_queries)} PromQL queries in {time.perf_counter() - fetch_started:.2f}s")
+
     domain_data = {}
     for key in domain_keys:
         try:
+            lo, hi = domain_slices[key]
             domain_data[key] = _build_domain_data(
                 domain_key=key,
                 domain_conf=queries[key],
@@ -982,7 +1280,8 @@ def uploadFromLLM(start_ts: float, end_ts: float) -> Dict[str, object]:
                 end_ts=end_ts,
                 step=step,
                 resample=resample,
-                top_n=15
+                top_n=15,
+                prefetched=all_series[lo:hi]
             )
         except Exception as e:
             logger.error(f"Domain '{key}' build failed: {e}")
@@ -1016,6 +1315,20 @@ def uploadFromLLM(start_ts: float, end_ts: float) -> Dict[str, object]:
                 mem_sections.append(sec)
     except Exception:
         pass
+    # Динамика ошибок в логах (агрегаты Loki) — компактный контекст для микросервисов и итога
+    logs_pack = {"sections": []}
+    if callable(log_metrics):
+        try:
+            log_metrics = log_metrics()
+        except Exception as e:
+            logger.error(f"Log metrics fetch failed: {e}")
+            log_metrics = None
+    if log_metrics:
+        try:
+            logs_pack = build_context_pack(_log_metrics_to_labeled(log_metrics, resample), top_n=15)
+        except Exception as e:
+            logger.error(f"Log metrics context build failed: {e}")
+
     ms_ctx_obj = {
         "domain": "microservices",
         "time_range": {"start": start_ts, "end": end_ts},
@@ -1025,29 +1338,38 @@ def uploadFromLLM(start_ts: float, end_ts: float) -> Dict[str, object]:
             "memory_sections": mem_sections
         }
     }
+    if logs_pack["sections"]:
+        ms_ctx_obj["aux_resources"]["log_sections"] = logs_pack["sections"]
     ms_ctx = json.dumps(ms_ctx_obj, ensure_ascii=False)
 
-    # Two-pass + self-consistency (k=3)
-    try:
-        answer_jvm, jvm_parsed = _ask_domain_analysis(prompt_jvm, jvm_ctx)
-    except Exception as e:
-        logger.error(f"LLM jvm analysis failed: {e}")
-        answer_jvm, jvm_parsed = ("{}", None)
-    try:
-        answer_database, database_parsed = _ask_domain_analysis(prompt_database, database_ctx)
-    except Exception as e:
-        logger.error(f"LLM database analysis failed: {e}")
-        answer_database, database_parsed = ("{}", None)
-    try:
-        answer_kafka, kafka_parsed = _ask_domain_analysis(prompt_kafka, kafka_ctx)
-    except Exception as e:
-        logger.error(f"LLM kafka analysis failed: {e}")
-        answer_kafka, kafka_parsed = ("{}", None)
-    try:
-        answer_ms, ms_parsed = _ask_domain_analysis(prompt_microservices, ms_ctx)
-    except Exception as e:
-        logger.error(f"LLM microservices analysis failed: {e}")
-        answer_ms, ms_parsed = ("{}", None)
+    # Two-pass + self-consistency (k=3). Четыре доменных анализа выполняются параллельно,
+    # фактическое число одновременных запросов к GigaChat ограничено llm.gigachat.max_concurrency.
+    def _run_domain(domain: str, prompt_text: str, ctx: str) -> tuple[str, Optional[LLMAnalysis]]:
+        try:
+            return _ask_domain_analysis(prompt_text, ctx)
+        except Exception as e:
+            logger.error(f"LLM {domain} analysis failed: {e}")
+            return ("{}", None)
+        finally:
+            _report_progress()
+
+    domain_jobs = {
+        "jvm": (prompt_jvm, jvm_ctx),
+        "database": (prompt_database, database_ctx),
+        "kafka": (prompt_kafka, kafka_ctx),
+        "microservices": (prompt_microservices, ms_ctx),
+    }
+    with ThreadPoolExecutor(max_workers=len(domain_jobs), thread_name_prefix="llm-domain") as executor:
+        domain_futures = {
+            domain: executor.submit(_run_domain, domain, prompt_text, ctx)
+            for domain, (prompt_text, ctx) in domain_jobs.items()
+        }
+        domain_answers = {domain: future.result() for domain, future in domain_futures.items()}
+
+    answer_jvm, jvm_parsed = domain_answers["jvm"]
+    answer_database, database_parsed = domain_answers["database"]
+    answer_kafka, kafka_parsed = domain_answers["kafka"]
+    answer_ms, ms_parsed = domain_answers["microservices"]
 
     merged_prompt_overall = (
         prompt_overall
@@ -1064,9 +1386,11 @@ def uploadFromLLM(start_ts: float, end_ts: float) -> Dict[str, object]:
             "database": database_pack,
             "kafka": kafka_pack,
             "microservices": ms_pack
-        }
+        },
+        **({"logs": logs_pack} if logs_pack["sections"] else {})
     }, ensure_ascii=False)
     final_answer, final_parsed = llm_two_pass_self_consistency(user_prompt=merged_prompt_overall, data_context=overall_ctx, k=3)
+    _report_progress()
 
     return {
         "jvm": f"{jvm_full_data}\n\nАнализ JVM:\n{answer_jvm}",
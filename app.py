@@ -1,5 +1,5 @@
 from flask import Flask, request, jsonify, render_template
-from update_page import update_report  # Замените на имя файла, где находится `update_report`
+from report_jobs import report_jobs  # Очередь асинхронных задач на создание отчетов
 from config import CONFIG  # Базовые настройки
 from metrics_config import METRICS_CONFIG  # Конфигурация метрик
 from datetime import datetime
@@ -19,6 +19,20 @@ def convert_to_timestamp(date_str):
     dt = datetime.strptime(date_str, "%Y-%m-%dT%H:%M")
     return int(dt.timestamp() * 1000)
 
+# Вспомогательная функция для разбора флагов запроса
+def parse_bool(value, default=True):
+    """Флаг из JSON/формы: настоящие bool, числа и строки ("false", "0", "no" и "off" — ложь)."""
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    text = str(value).strip().lower()
+    if text == "":
+        return default
+    return text not in {"false", "0", "no", "off"}
+
 @app.route('/services', methods=['GET'])
 def get_services():
     # Извлекаем все ключи словаря METRICS_CONFIG — это и есть названия сервисов
@@ -32,6 +46,8 @@ def create_report():
     start_str = data.get('start')
     end_str = data.get('end')
     service = data.get('service')
+    # Кэш рендеров Grafana можно отключить для отдельного запроса: "use_render_cache": false
+    use_render_cache = parse_bool(data.get('use_render_cache'), default=True)
 
     # Проверка наличия необходимых параметров
     if not all([start_str, end_str, service]):
@@ -49,12 +65,25 @@ def create_report():
         return jsonify({"status": "error", "message": f"Конфигурация для сервиса '{service}' не найдена"}), 400
 
     try:
-        # Вызываем update_report с параметрами из POST-запроса
-        response = update_report(start, end, service)
-        return jsonify({"status": "success", "message": "Отчет создан успешно"}), 200
+        # Ставим отчет в очередь; прогресс доступен по GET /jobs/<job_id>
+        job_id = report_jobs.submit(start, end, service, use_render_cache=use_render_cache)
+        return jsonify({"status": "accepted", "job_id": job_id, "message": "Отчет поставлен в очередь"}), 202
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Статус задачи на создание отчета
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = report_jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Задача '{job_id}' не найдена"}), 404
+    return jsonify(job), 200
+
+# Список задач на создание отчетов
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify(report_jobs.list()), 200
+
 if __name__ == '__main__':
     # app.run(debug=True)
     app.run(host='0.0.0.0')
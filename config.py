@@ -9,5 +9,82 @@ CONFIG = {
     'url_basic': 'https://confluence.test.ru', #confluence
     'space_conf': 'DPSUPP', #confluence
     'grafana_base_url': 'http://0.0.0.0:3000',
-    'loki_url': 'http://gateway.loki.url/loki/api/v1/query_range'
+    'loki_url': 'http://gateway.loki.url/loki/api/v1/query_range',
+    # Выгрузка логов Loki (data_collectors/loki_collector.py): постранично, с бюджетом на размер файла
+    'loki': {
+        'page_limit': 1000, # записей на один запрос query_range (не больше max_entries_limit_per_query в Loki)
+        'max_page_limit': 5000, # до скольких записей увеличивать страницу, если в одной наносекунде записей больше page_limit
+        'max_lines': 200000, # максимум строк в одном файле логов
+        'max_bytes': 50 * 1024 * 1024, # максимум байт в одном файле логов
+        'shards': 4, # на сколько частей по времени делится окно теста
+        'shard_workers': 4, # одновременных запросов к Loki на один файл логов
+        'min_shard_sec': 300, # окна короче shards * min_shard_sec делятся на меньшее число частей
+        'shard_prefetch_pages': 4, # страниц (по page_limit записей), на которые шард может опережать запись в файл
+        # Сжатие логов по шаблонам: вместо всех строк — группы с числом строк, первым/последним временем и примером
+        'condense': {
+            'enabled': False, # значение по умолчанию; переопределяется полем "condense" записи logs в metrics_config.py
+            'max_clusters': 500,
+            'sample_lines': 200 # сколько первых строк приложить без обработки
+        },
+        # Сжатие вложений логов: лог больше min_bytes сохраняется архивом, на странице — первые строки и ссылка
+        'compress': {
+            'format': None, # None (без сжатия), 'gzip' или 'zstd' (нужен пакет zstandard, иначе gzip)
+            'min_bytes': 1024 * 1024, # логи меньше этого размера прикладываются как есть (view-file)
+            'preview_lines': 50 # строк лога в предпросмотре на странице
+        },
+        # Записи logs с "mode": "metrics" — вместо строк логов метрический запрос count_over_time на стороне Loki
+        'metrics': {
+            'step': '60s', # шаг агрегации (переопределяется полем "step" записи logs)
+            'group_by': 'level', # метка группировки (переопределяется полем "group_by" записи logs)
+            'workers': 4 # одновременных метрических запросов
+        }
+    },
+    'collect_workers': 8, # число потоков для параллельного сбора графиков Grafana и логов Loki
+    'report_workers': 2, # число одновременно создаваемых отчетов (задачи POST /create_report)
+    'report_jobs_keep': 100, # сколько завершенных задач хранить для GET /jobs
+    'attachment_batch_size': 10, # сколько изображений/логов загружать во вложения одним запросом
+    'render_spool_max_bytes': 8 * 1024 * 1024, # изображение панели держится в памяти до этого размера, дальше — во временном файле
+    # InfluxDB с результатами LoadRunner (data_collectors/influxdb_collector.py): один общий клиент на процесс
+    'influxdb': {
+        'host': 'rbqacas00004.gts.rus.socgen',
+        'port': 8086,
+        'username': 'pcuser',
+        'password': 'pcuser',
+        'database': 'test',
+        'pool_size': 4, # keep-alive соединений общего клиента
+        'chunk_size': 10000, # точек в порции при потоковом чтении (chunked=True)
+        'bounds_cache_ttl_sec': 300, # сколько кэшировать границы прогона (FIRST/LAST) по run_id
+        'bounds_settle_sec': 300, # прогон с последней точкой моложе этого считается идущим, его границы не кэшируются
+        'stage_statistics_cache_ttl_sec': 300, # сколько кэшировать статистики по стадиям (get_lr_stage_statistics) по (run_id, стадии)
+        'steps_downsample': None, # например '10s': ступени нагрузки ищутся по LAST(value) в интервалах GROUP BY time() вместо всех точек
+        'stage_table_layout': 'wide' # таблицы по стадиям: 'wide' (стадии — столбцы) или 'long' (строка на транзакцию и стадию)
+    },
+    # Клиент рендерера Grafana (GrafanaRenderer в data_collectors/grafana_collector.py)
+    'grafana_renderer': {
+        'max_concurrency': 4, # одновременных рендеров на хост Grafana; снижается вдвое при 429/5xx/таймаутах
+        'min_concurrency': 1,
+        'panel_timeout_sec': 90, # общий лимит на панель: ожидание слота, попытки и паузы между ними
+        'connect_timeout_sec': 10,
+        'max_attempts': 3, # попыток при перегрузке рендерера
+        'backoff_factor': 1.0, # пауза между попытками, если нет Retry-After: backoff_factor * 2 ** (попытка - 1)
+        'max_retry_after_sec': 30, # верхняя граница паузы по Retry-After (и паузы всего хоста)
+        'hosts': {} # переопределения по имени хоста Grafana
+    },
+    # Дисковый кэш рендеров панелей Grafana (data_collectors/render_cache.py); кэшируются только закрытые окна
+    'render_cache': {
+        'enabled': True,
+        'dir': 'data_collectors/render_cache',
+        'max_bytes': 512 * 1024 * 1024, # при превышении удаляются давно не использованные рендеры
+        'min_age_sec': 60 # окно считается закрытым, если его конец старше этого значения
+    },
+    # Общий HTTP-клиент (utils/http_client.py): keep-alive пулы соединений на хост, повторы и таймауты
+    'http': {
+        'pool_connections': 4,
+        'pool_maxsize': 32, # не меньше collect_workers
+        'retries': 3,
+        'backoff_factor': 0.5,
+        'status_forcelist': [502, 503, 504],
+        'timeout': [10, 120], # (connect, read), секунды
+        'hosts': {} # переопределения по имени хоста, например {'grafana.local': {'pool_maxsize': 8}}
+    }
 }
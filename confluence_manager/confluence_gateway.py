@@ -0,0 +1,104 @@
+import hashlib
+import threading
+
+from atlassian import Confluence
+
+from utils import http_client
+
+
+class ConfluenceGateway:
+    """
+    Подключение к Confluence, общее для всех операций одного отчета:
+    REST-клиент atlassian и загрузка вложений используют одну сессию
+    с пулом keep-alive соединений (utils/http_client).
+    """
+
+    def __init__(self, url, username, password, verify_ssl=False):
+        self.url = url.rstrip('/')
+        self.session = http_client.new_session(url)
+        self.session.verify = verify_ssl
+        # atlassian выставляет basic auth на переданную сессию
+        self.client = Confluence(
+            url=url,
+            username=username,
+            password=password,
+            verify_ssl=verify_ssl,
+            session=self.session
+        )
+
+    def upload_attachment(self, page_id, filename, fileobj, content_type=None):
+        """
+        Загружает вложение на страницу Confluence.
+
+        :param page_id: str, идентификатор страницы
+        :param filename: str, имя вложения на странице
+        :param fileobj: file-like объект с содержимым
+        :param content_type: str, MIME-тип (опционально)
+        :return: response, ответ Confluence
+        """
+        url = f"{self.url}/rest/api/content/{page_id}/child/attachment"
+        file_part = (filename, fileobj, content_type) if content_type else (filename, fileobj)
+        return self.session.post(
+            url,
+            files={"file": file_part},
+            headers={'X-Atlassian-Token': 'nocheck'},
+        )
+
+    def upload_attachments(self, page_id, files, batch_size=None):
+        """
+        Загружает несколько вложений пакетами: каждый пакет — один multipart-запрос
+        с несколькими частями file. Если пакет отклонен целиком, его файлы
+        загружаются по одному, чтобы ошибка одного файла не теряла остальные.
+
+        :param page_id: str, идентификатор страницы
+        :param files: list, элементы (имя вложения, file-like объект) или (имя, объект, MIME-тип)
+        :param batch_size: int, максимум файлов в одном запросе (по умолчанию — все в одном)
+        :return: dict, {имя вложения: метаданные вложения из ответа Confluence} для загруженных файлов
+        """
+        uploaded = {}
+        if not files:
+            return uploaded
+        batch_size = max(1, int(batch_size or len(files)))
+        url = f"{self.url}/rest/api/content/{page_id}/child/attachment"
+
+        for i in range(0, len(files), batch_size):
+            batch = files[i:i + batch_size]
+            parts = [("file", tuple(item)) for item in batch]
+            response = self.session.post(url, files=parts, headers={'X-Atlassian-Token': 'nocheck'})
+            if response.status_code in (200, 201):
+                for attachment in response.json().get("results", []):
+                    uploaded[attachment.get("title")] = attachment
+                continue
+
+            print(f"Ошибка при пакетной отправке вложений: {response.status_code} - {response.text}")
+            if len(batch) == 1:
+                continue
+            for item in batch:
+                item[1].seek(0)
+                single = self.upload_attachment(page_id, *item)
+                if single.status_code in (200, 201):
+                    for attachment in single.json().get("results", []):
+                        uploaded[attachment.get("title")] = attachment
+                else:
+                    print(f"Ошибка при отправке вложения {item[0]}: {single.status_code} - {single.text}")
+
+        return uploaded
+
+    def close(self):
+        self.session.close()
+
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+
+def get_confluence_gateway(url, username, password, verify_ssl=False):
+    """Возвращает общий для процесса ConfluenceGateway для указанных URL и учетных данных."""
+    secret = hashlib.sha256(str(password).encode('utf-8')).hexdigest()
+    key = (url.rstrip('/'), username, secret, verify_ssl)
+    with _gateways_lock:
+        gateway = _gateways.get(key)
+        if gateway is None:
+            gateway = ConfluenceGateway(url, username, password, verify_ssl=verify_ssl)
+            _gateways[key] = gateway
+        return gateway
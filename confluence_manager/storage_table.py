@@ -0,0 +1,132 @@
+# storage_table.py
+
+from fnmatch import fnmatchcase
+from xml.sax.saxutils import escape
+
+
+# Подсветка ячейки в Confluence Storage (цвет из палитры таблиц Confluence)
+_HIGHLIGHT_CELL = '<td class="highlight-{color}" data-highlight-colour="{color}">'
+
+
+def _column_rule(rules, column):
+    """
+    Возвращает правило для столбца: точное совпадение имени или первый подходящий шаблон fnmatch
+    (например, 'percentile_90_*').
+    """
+    if not rules:
+        return None
+    column = str(column)
+    if column in rules:
+        return rules[column]
+    for pattern, rule in rules.items():
+        if fnmatchcase(column, str(pattern)):
+            return rule
+    return None
+
+
+def _formatter(spec, na_rep):
+    """
+    Строит функцию форматирования значения ячейки.
+
+    :param spec: None (str(value)), строка формата ('.4f', '{:,.1f} ms') или callable(value) -> str
+    :param na_rep: str, представление пропусков или None (пропуски выводятся через str, как есть)
+    """
+    if spec is None:
+        convert = str
+    elif callable(spec):
+        convert = spec
+    elif '{' in spec:
+        convert = spec.format
+    else:
+        convert = lambda value: format(value, spec)
+
+    if na_rep is None:
+        return convert
+
+    def format_value(value):
+        if value is None or (isinstance(value, float) and value != value):
+            return na_rep
+        return convert(value)
+    return format_value
+
+
+def _breach_check(rule):
+    """Правило подсветки: число — порог (подсвечиваются значения больше него) или callable(value) -> bool."""
+    if callable(rule):
+        return rule
+    threshold = float(rule)
+
+    def exceeds(value):
+        try:
+            return float(value) > threshold
+        except (TypeError, ValueError):
+            return False
+    return exceeds
+
+
+def _render_column(values, spec, rule, na_rep, color):
+    """Форматирует столбец целиком в список готовых ячеек <td>...</td>."""
+    format_value = _formatter(spec, na_rep)
+    if rule is None:
+        return ['<td>' + escape(format_value(value)) + '</td>' for value in values]
+
+    breached = _breach_check(rule)
+    highlight = _HIGHLIGHT_CELL.format(color=color)
+    return [
+        (highlight if breached(value) else '<td>') + escape(format_value(value)) + '</td>'
+        for value in values
+    ]
+
+
+def render_table_rows(df, formats=None, highlight=None, index=False, na_rep='', highlight_color='red'):
+    """
+    Преобразует DataFrame в строки таблицы Confluence Storage: строка заголовка <th> и строки данных <td>.
+
+    Ячейки формируются по столбцам (values столбца без iterrows) и склеиваются одним join,
+    все значения и заголовки экранируются для XML.
+
+    :param df: исходный DataFrame
+    :param formats: dict {столбец или шаблон fnmatch: строка формата или callable(value) -> str}
+    :param highlight: dict {столбец или шаблон fnmatch: порог SLA (подсветка значений больше порога) или callable(value) -> bool}
+    :param index: bool, выводить индекс первым столбцом
+    :param na_rep: str, представление пропусков (None — выводить как str(value))
+    :param highlight_color: str, цвет подсветки ячеек с нарушением (red, yellow, green, blue, grey)
+    :return: str, строки <tr>...</tr> без обертки <table>
+    """
+    columns = list(df.columns)
+    cells = [
+        _render_column(
+            df.iloc[:, position].tolist(),
+            _column_rule(formats, column),
+            _column_rule(highlight, column),
+            na_rep,
+            highlight_color,
+        )
+        for position, column in enumerate(columns)
+    ]
+    headers = columns
+    if index:
+        index_name = df.index.name if df.index.name is not None else ''
+        headers = [index_name] + columns
+        cells.insert(0, ['<td>' + escape(str(value)) + '</td>' for value in df.index])
+
+    parts = ['<tr>']
+    parts.extend('<th>' + escape(str(column)) + '</th>' for column in headers)
+    parts.append('</tr>')
+    for row in zip(*cells):
+        parts.append('<tr>')
+        parts.extend(row)
+        parts.append('</tr>')
+    return ''.join(parts)
+
+
+def render_table(df, **kwargs):
+    """
+    Преобразует DataFrame в полную таблицу Confluence Storage (<table><tbody>...</tbody></table>).
+
+    :param df: исходный DataFrame
+    :param kwargs: параметры render_table_rows (formats, highlight, index, na_rep, highlight_color)
+    :return: str, таблица в формате Confluence Storage
+    """
+    return '<table><tbody>' + render_table_rows(df, **kwargs) + '</tbody></table>'
+
@@ -4,6 +4,7 @@ import pandas as pd
 import json
 from bs4 import BeautifulSoup
 from atlassian import Confluence
+from confluence_manager.confluence_gateway import get_confluence_gateway
 from datetime import datetime
 from getpass import getpass
 
@@ -12,13 +13,8 @@ import re
 
 
 
-def copy_confluence_page(url, username, password ,page_id, page_parent_id):
-    confluence = Confluence(
-        url=url,
-        username=username,
-        password=password,
-        verify_ssl=False
-    )
+def copy_confluence_page(url, username, password ,page_id, page_parent_id, gateway=None):
+    confluence = (gateway or get_confluence_gateway(url, username, password)).client
     # Загружаем страницу
     try:
         page = confluence.get_page_by_id(page_id, expand='body.storage,history,space,version', status=None, version=None)
@@ -62,13 +58,8 @@ def copy_confluence_page(url, username, password ,page_id, page_parent_id):
 
 
 
-def update_confluence_page_old(url, username, password, page_id, data_to_find, replace_text):
-    confluence = Confluence(
-        url=url,
-        username=username,
-        password=password,
-        verify_ssl=False
-    )
+def update_confluence_page_old(url, username, password, page_id, data_to_find, replace_text, gateway=None):
+    confluence = (gateway or get_confluence_gateway(url, username, password)).client
     # Загружаем страницу
     try:
         page = confluence.get_page_by_id(page_id, expand='body.storage,history,space,version', status=None, version=None)
@@ -99,13 +90,8 @@ def update_confluence_page_old(url, username, password, page_id, data_to_find, r
 
     print("Страница успешно обновлена.")
   
-def update_confluence_page(url, username, password, page_id, data_to_find, replace_text):
-    confluence = Confluence(
-        url=url,
-        username=username,
-        password=password,
-        verify_ssl=False
-    )
+def update_confluence_page(url, username, password, page_id, data_to_find, replace_text, gateway=None):
+    confluence = (gateway or get_confluence_gateway(url, username, password)).client
     
     try:
         page = confluence.get_page_by_id(page_id, expand='body.storage,history,space,version')
@@ -282,14 +268,9 @@ def render_llm_markdown(report: dict) -> str:
     return "\n".join(md_lines)
 
 
-def update_confluence_page_multi(url, username, password, page_id, replacements: dict) -> str:
+def update_confluence_page_multi(url, username, password, page_id, replacements: dict, gateway=None) -> str:
     """Один проход по странице: заменить несколько плейсхолдеров. Отсутствующие не считаем ошибкой."""
-    confluence = Confluence(
-        url=url,
-        username=username,
-        password=password,
-        verify_ssl=False
-    )
+    confluence = (gateway or get_confluence_gateway(url, username, password)).client
 
     try:
         page = confluence.get_page_by_id(page_id, expand='body.storage,history,space,version')
@@ -315,7 +296,9 @@ def update_confluence_page_multi(url, username, password, page_id, replacements:
                     inner = ph[2:-2].strip()
                     if inner:
                         pattern = r"\$\$\s*" + re.escape(inner) + r"\s*\$\$"
-                        new_html, num = re.subn(pattern, str(value), html)
+                        # Замена функцией: обратные слэши и \g<...> в тексте вставляются как есть
+                        replacement = str(value)
+                        new_html, num = re.subn(pattern, lambda _m: replacement, html)
                         if num > 0:
                             html = new_html
                             replaced_any = True
@@ -1,11 +1,20 @@
 import json
 import os
 import sys
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
 
 import numpy as np
 from requests.auth import HTTPBasicAuth
 import requests
 import shutil
+import tempfile
+from config import CONFIG
+from utils import http_client
+from data_collectors.render_cache import get_render_cache, render_cache_key, is_closed_window
+from confluence_manager.confluence_gateway import get_confluence_gateway
 # import yaml
 
 # with open('config.yaml', 'r') as file:
@@ -13,7 +22,7 @@ import shutil
 
 #     config = yaml.safe_load(file)
 
-def send_file_to_attachment(url_basic, auth_header, page_id, filename):
+def send_file_to_attachment(url_basic, auth_header, page_id, filename, gateway=None):
     """
     Функция для отправки файла в качестве вложения на страницу Confluence.
 
@@ -22,6 +31,7 @@ def send_file_to_attachment(url_basic, auth_header, page_id, filename):
     :param page_id: str, идентификатор страницы Confluence, на которую нужно добавить вложение
     :param space: str, идентификатор пространства Confluence
     :param filename: str, путь к файлу, который нужно отправить в качестве вложения
+    :param gateway: ConfluenceGateway, общее подключение к Confluence (опционально)
     :return: response, ответ от сервера Confluence после попытки отправить файл
     """
     try:
@@ -31,10 +41,13 @@ def send_file_to_attachment(url_basic, auth_header, page_id, filename):
 
         # Открытие файла
         with open(filename, 'rb') as file:
+            if gateway is not None:
+                return gateway.upload_attachment(page_id, os.path.basename(filename), file)
+
             files = {"file": file}
 
             # Отправка POST запроса с файлом и необходимыми заголовками
-            response = requests.post(
+            response = http_client.post(
                 url,
                 verify=False,
                 files=files,
@@ -70,21 +83,22 @@ def downloadImagesLogin(image_url, filename, username, password):
 
     try:
         # Отправка GET запроса для получения изображения с базовой аутентификацией
-        r = requests.get(image_url, stream=True, auth=(username, password), verify=False)
-        print(image_url)
-        print(r.status_code)
+        # (with закрывает ответ и возвращает соединение в пул даже при ошибочном статусе)
+        with http_client.get(image_url, stream=True, auth=(username, password), verify=False) as r:
+            print(image_url)
+            print(r.status_code)
 
-        # Проверка статуса ответа
-        if r.status_code == 200:
-            r.raw.decode_content = True
+            # Проверка статуса ответа
+            if r.status_code == 200:
+                r.raw.decode_content = True
 
-            # Сохранение изображения в локальном каталоге
-            with open(f'data_collectors/temporary_files/{filename}.jpg', 'wb') as f:
-                shutil.copyfileobj(r.raw, f)
+                # Сохранение изображения в локальном каталоге
+                with open(f'data_collectors/temporary_files/{filename}.jpg', 'wb') as f:
+                    shutil.copyfileobj(r.raw, f)
 
-            print('Image sucessfully Downloaded: ', filename)
-        else:
-            print('Image Couldn\'t be retreived')
+                print('Image sucessfully Downloaded: ', filename)
+            else:
+                print('Image Couldn\'t be retreived')
 
     except requests.exceptions.RequestException as e:
         print(f"Произошла ошибка при отправке запроса: {str(e)}")
@@ -95,9 +109,264 @@ def downloadImagesLogin(image_url, filename, username, password):
 
 
 
-def uploadFromGrafana(user, password, url_basic, space_conf, page_id, util_metrics, service, grafana_login, grafana_pass):
+def grafana_image_macro(attachment_name):
+    """Разметка Confluence для вставки изображения-вложения на страницу."""
+    return f'<ac:image><ri:attachment ri:filename="{attachment_name}" /></ac:image>'
+
+
+
+class _AdaptiveLimiter:
     """
-    Функция для загрузки изображений из Grafana, отправки их на Confluence и удаления локальных копий.
+    Ограничитель числа одновременных рендеров на один хост Grafana (AIMD).
+
+    Каждый успешный рендер увеличивает лимит на 1/limit (примерно +1 за «окно» запросов),
+    перегрузка рендерера (429, 5xx, таймаут) уменьшает его вдвое, но не ниже min_limit.
+    Retry-After приостанавливает выдачу новых слотов до указанного момента.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Занимает слот; возвращает False, если слот не получен за timeout секунд (None — ждать без ограничения)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                pause = self._paused_until - now
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return True
+                waits = [pause] if pause > 0 else []
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    waits.append(deadline - now)
+                self._cond.wait(min(waits) if waits else None)
+
+    def release(self, outcome):
+        """outcome: "ok" — успешный рендер, "throttled" — признак перегрузки, иначе лимит не меняется."""
+        with self._cond:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            elif outcome == "throttled":
+                self.limit = max(float(self.min_limit), self.limit / 2)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+
+class _PanelTimeout(Exception):
+    """Рендер панели не уложился в panel_timeout_sec."""
+
+
+def _parse_retry_after(value):
+    """Значение заголовка Retry-After в секундах (число или HTTP-дата) или None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Состояние по хостам Grafana, общее для всех GrafanaRenderer процесса:
+# {(хост, max_concurrency, min_concurrency): (limiter, session)} — рендереры с другими лимитами получают свой limiter
+_renderer_hosts = {}
+_renderer_hosts_lock = threading.Lock()
+
+
+class GrafanaRenderer:
+    """
+    Клиент рендерера изображений Grafana (/render/d-solo) с ограничением нагрузки.
+
+    Число одновременных рендеров на хост Grafana ограничено и адаптивно подстраивается
+    под ответы рендерера (429/5xx/таймауты уменьшают лимит, успешные рендеры — увеличивают).
+    Для каждой панели действует общий таймаут рендера, перегруженный рендерер
+    повторяется с паузой (Retry-After или экспоненциальной). По каждой панели
+    возвращается время ожидания слота и время самого рендера.
+    Настройки — CONFIG['grafana_renderer'].
+    """
+
+    def __init__(self, username, password, settings=None):
+        self.username = username
+        self.password = password
+        settings = dict(settings or CONFIG.get('grafana_renderer', {}) or {})
+        self._hosts_cfg = settings.pop('hosts', {}) or {}
+        self.settings = settings
+
+    def _setting(self, host, name, default):
+        host_cfg = self._hosts_cfg.get(host, {}) or {}
+        return host_cfg.get(name, self.settings.get(name, default))
+
+    def _host_state(self, image_url):
+        host = (urlparse(image_url).hostname or '').lower()
+        max_limit = int(self._setting(host, 'max_concurrency', 4))
+        min_limit = int(self._setting(host, 'min_concurrency', 1))
+        key = (host, max_limit, min_limit)
+        with _renderer_hosts_lock:
+            state = _renderer_hosts.get(key)
+            if state is None:
+                limiter = _AdaptiveLimiter(max_limit=max_limit, min_limit=min_limit)
+                # Повторы выполняет сам рендерер с учетом лимита, поэтому у сессии они отключены
+                session = http_client.new_session(image_url, retries=0)
+                state = (limiter, session)
+                _renderer_hosts[key] = state
+            return host, state
+
+    def render(self, image_url, use_cache=True, spool_max_bytes=None):
+        """
+        Рендерит панель в буфер с учетом лимита рендерера и кэша рендеров.
+
+        :param image_url: str, URL-адрес изображения (render/d-solo)
+        :param use_cache: bool, брать рендеры закрытых окон из кэша (False — рендерить заново и обновить запись в кэше)
+        :param spool_max_bytes: int, порог размера буфера в памяти (по умолчанию CONFIG['render_spool_max_bytes'])
+        :return: tuple, (file-like объект на начале или None, dict со статистикой:
+                 cached, queue_wait, render_time, attempts, status)
+        """
+        stats = {"cached": False, "queue_wait": 0.0, "render_time": 0.0, "attempts": 0, "status": None}
+        if spool_max_bytes is None:
+            spool_max_bytes = int(CONFIG.get('render_spool_max_bytes', 8 * 1024 * 1024))
+
+        # use_cache=False пропускает только чтение: свежий рендер закрытого окна
+        # все равно сохраняется и заменяет устаревшую запись в кэше
+        cache = get_render_cache()
+        cache_key = None
+        if cache is not None:
+            min_age_sec = int(CONFIG['render_cache'].get('min_age_sec', 60))
+            if is_closed_window(image_url, min_age_sec):
+                cache_key = render_cache_key(image_url)
+                cached = cache.get(cache_key) if use_cache else None
+                if cached is not None:
+                    print(f"Рендер из кэша: {image_url}")
+                    stats["cached"] = True
+                    return cached, stats
+
+        host, (limiter, session) = self._host_state(image_url)
+        max_attempts = max(1, int(self._setting(host, 'max_attempts', 3)))
+        backoff_factor = float(self._setting(host, 'backoff_factor', 1.0))
+        panel_timeout = float(self._setting(host, 'panel_timeout_sec', 90))
+        connect_timeout = float(self._setting(host, 'connect_timeout_sec', 10))
+        max_retry_after = float(self._setting(host, 'max_retry_after_sec', 30))
+        # panel_timeout_sec — общий лимит на панель: ожидание слота, все попытки и паузы между ними
+        deadline = time.monotonic() + panel_timeout
+
+        for attempt in range(1, max_attempts + 1):
+            if attempt > 1 and time.monotonic() >= deadline:
+                print(f"Рендер не уложился в {panel_timeout:.0f} с за {attempt - 1} попыток: {image_url}")
+                break
+            stats["attempts"] = attempt
+            queued = time.perf_counter()
+            acquired = limiter.acquire(timeout=max(0.0, deadline - time.monotonic()))
+            started = time.perf_counter()
+            stats["queue_wait"] += started - queued
+            if not acquired:
+                print(f"Рендер не начат: нет свободного слота рендерера за {panel_timeout:.0f} с: {image_url}")
+                return None, stats
+            outcome = "error"
+            retry_after = None
+            try:
+                buffer, status, retry_after = self._fetch(
+                    session, image_url, spool_max_bytes, connect_timeout, deadline
+                )
+                stats["status"] = status
+                if status == 200:
+                    outcome = "ok"
+                    if cache_key is not None:
+                        cache.put(cache_key, buffer)
+                    return buffer, stats
+                if status == 429 or status >= 500:
+                    outcome = "throttled"
+                    print(f"Рендерер Grafana перегружен ({status}), попытка {attempt}/{max_attempts}: {image_url}")
+                else:
+                    print(f"Image Couldn't be retreived ({status}): {image_url}")
+                    return None, stats
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, _PanelTimeout) as e:
+                outcome = "throttled"
+                print(f"Таймаут/ошибка соединения рендерера, попытка {attempt}/{max_attempts}: {image_url}: {e}")
+            except requests.exceptions.RequestException as e:
+                print(f"Произошла ошибка при отправке запроса: {str(e)}")
+                return None, stats
+            finally:
+                stats["render_time"] += time.perf_counter() - started
+                limiter.release(outcome)
+
+            remaining = deadline - time.monotonic()
+            if attempt >= max_attempts or remaining <= 0:
+                break
+            if retry_after is not None:
+                # Retry-After ограничивается: ошибочно большое значение не должно останавливать весь хост
+                retry_after = min(retry_after, max_retry_after, remaining)
+                limiter.pause(retry_after)
+                time.sleep(retry_after)
+            else:
+                time.sleep(min(backoff_factor * 2 ** (attempt - 1), remaining))
+
+        return None, stats
+
+    def _fetch(self, session, image_url, spool_max_bytes, connect_timeout, deadline):
+        """Один запрос рендера до момента deadline (time.monotonic):
+        (буфер или None, HTTP-статус, Retry-After в секундах или None)."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise _PanelTimeout("время на панель исчерпано")
+        with session.get(image_url, stream=True, auth=(self.username, self.password), verify=False,
+                         timeout=(min(connect_timeout, remaining), remaining)) as r:
+            if r.status_code != 200:
+                return None, r.status_code, _parse_retry_after(r.headers.get('Retry-After'))
+
+            buffer = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                if time.monotonic() > deadline:
+                    buffer.close()
+                    raise _PanelTimeout("рендер не уложился в panel_timeout_sec")
+                buffer.write(chunk)
+            buffer.seek(0)
+            return buffer, r.status_code, None
+
+
+
+def render_panel_to_buffer(image_url, username, password, spool_max_bytes=None, use_cache=True):
+    """
+    Функция для рендера панели Grafana в буфер в памяти без временных файлов на диске.
+
+    Тело ответа рендерера читается потоком в SpooledTemporaryFile: до spool_max_bytes
+    данные хранятся в памяти, при превышении буфер автоматически переносится на диск.
+    Рендеры закрытых исторических окон берутся из дискового кэша (CONFIG['render_cache'])
+    и сохраняются в него после успешного рендера. Запрос выполняется через GrafanaRenderer
+    с ограничением числа одновременных рендеров на хост.
+
+    :param image_url: str, URL-адрес изображения (render/d-solo)
+    :param username: str, логин для аутентификации в Grafana
+    :param password: str, пароль для аутентификации в Grafana
+    :param spool_max_bytes: int, порог размера буфера в памяти (по умолчанию CONFIG['render_spool_max_bytes'])
+    :param use_cache: bool, использовать кэш рендеров (False — всегда рендерить заново, результат обновляет кэш)
+    :return: file-like объект, установленный на начало, или None при ошибке
+    """
+    buffer, _ = GrafanaRenderer(username, password).render(
+        image_url, use_cache=use_cache, spool_max_bytes=spool_max_bytes
+    )
+    return buffer
+
+
+
+def uploadFromGrafana(user, password, url_basic, space_conf, page_id, util_metrics, service, grafana_login, grafana_pass, gateway=None, use_render_cache=True):
+    """
+    Функция для загрузки изображений из Grafana и отправки их на Confluence.
+    Изображение передается из ответа рендерера во вложение через буфер в памяти, без временных файлов.
 
     :param user: str, имя пользователя Grafana
     :param password: str, пароль пользователя Grafana
@@ -106,30 +375,32 @@ def uploadFromGrafana(user, password, url_basic, space_conf, page_id, util_metri
     :param page_id: str, идентификатор страницы Confluence, на которую нужно добавить изображение
     :param util_metrics: list, список метрик в формате [(имя метрики, URL-адрес изображения), ...]
     :param service: str, имя сервиса
+    :param gateway: ConfluenceGateway, общее подключение к Confluence (по умолчанию — общее для user/password)
+    :param use_render_cache: bool, брать рендеры закрытых окон из кэша
     :return: list, список изображений с разметкой для вставки на страницу Confluence
     """
     utils = ""
+    gateway = gateway or get_confluence_gateway(url_basic, user, password)
 
     for metric in util_metrics:
         try:
-            # Загрузка изображений
-            downloadImagesLogin(metric[1], metric[0] + '_' + service + '_' + page_id, grafana_login, grafana_pass)
+            attachment_name = f"{metric[0]}_{service}_{page_id}.jpg"
 
-            # Подготовка аргументов для отправки файла на Confluence
-            auth = HTTPBasicAuth(user, password)
-            file_path = f'data_collectors/temporary_files/{metric[0]}_{service}_{page_id}.jpg'
+            # Рендер изображения в буфер
+            buffer = render_panel_to_buffer(metric[1], grafana_login, grafana_pass, use_cache=use_render_cache)
+            if buffer is None:
+                continue
 
-            # Отправка файла на Confluence
-            send_file_to_attachment(url_basic, auth, page_id, file_path)
+            # Отправка буфера на Confluence
+            with buffer:
+                response = gateway.upload_attachment(page_id, attachment_name, buffer)
 
-            # Формирование разметки для вставки изображения на страницу Confluence
-            # utils.append(
-            #     f'<ac:image><ri:attachment ri:filename="{metric[0]}_{service}_{page_id}.jpg" /></ac:image>'
-            # )
-            utils = f'<ac:image><ri:attachment ri:filename="{metric[0]}_{service}_{page_id}.jpg" /></ac:image>'
+            if response.status_code not in (200, 201):
+                print(f"Ошибка при отправке файла: {response.status_code} - {response.text}")
+                continue
 
-            # Удаление локальной копии файла
-            os.remove(file_path)
+            # Формирование разметки для вставки изображения на страницу Confluence
+            utils = grafana_image_macro(attachment_name)
 
         except Exception as e:
             print(f"Произошла ошибка: {str(e)}")
@@ -311,7 +582,7 @@ def grafanaGraphicsUrl(host, uid, token, pathResult, timeStart, timeTo):
     print('\nStart to work with %s' % host)
     url = host + "/api/search"
     headers = {'Authorization': 'Bearer ' + token}
-    r = requests.get(url, headers=headers, verify=False)
+    r = http_client.get(url, headers=headers, verify=False)
 
     # Проверка доступности страницы
     if (r.status_code == 200):
@@ -341,7 +612,7 @@ def grafanaGraphicsUrl(host, uid, token, pathResult, timeStart, timeTo):
     # Create the url request to find all graphics in dashboard
     urlReqDB = host + "/api/dashboards/uid/" + uid
     print("URL of dashboard by uid is ", urlReqDB)
-    reqDB = requests.get(urlReqDB, headers=headers, verify=False)
+    reqDB = http_client.get(urlReqDB, headers=headers, verify=False)
     # print("text of reqDB\n", reqDB.text)
 
     # Page content to JSON format
@@ -402,7 +673,7 @@ def grafanaGraphicsUrl(host, uid, token, pathResult, timeStart, timeTo):
             # print("Panel " + str(panelId) + ": " + urlReqGraphNew)
             fileName = "Image_" + uid + "_" + str(panelId)
 
-            r = requests.get(urlReqGraphNew, stream=True, headers=headers, verify=False)
+            r = http_client.get(urlReqGraphNew, stream=True, headers=headers, verify=False)
             if r.status_code == 200:
                 r.raw.decode_content = True
                 # urllib.request.urlretrieve(urlReqGraphNew, fileName)
@@ -1,28 +1,329 @@
 import datetime
 import re
+import threading
+import time
 from datetime import datetime
+from urllib.parse import urlencode
 from influxdb import InfluxDBClient
+from influxdb.resultset import ResultSet
+import numpy as np
 import pandas as pd
+from config import CONFIG  # Базовые настройки
+from confluence_manager.storage_table import render_table_rows
+
+
+_influx_client = None
+_influx_client_lock = threading.Lock()
+
+
+def get_influx_client():
+    """
+    Возвращает общий для процесса клиент InfluxDB (создается при первом обращении).
+
+    Клиент держит пул keep-alive соединений размером CONFIG['influxdb']['pool_size']
+    и используется всеми функциями модуля; закрывать его после запроса не нужно.
+    """
+    global _influx_client
+    with _influx_client_lock:
+        if _influx_client is None:
+            influx_cfg = CONFIG.get('influxdb', {})
+            _influx_client = InfluxDBClient(
+                host=influx_cfg.get('host', 'rbqacas00004.gts.rus.socgen'),
+                port=int(influx_cfg.get('port', 8086)),
+                username=influx_cfg.get('username', 'pcuser'),
+                password=influx_cfg.get('password', 'pcuser'),
+                database=influx_cfg.get('database', 'test'),
+                pool_size=int(influx_cfg.get('pool_size', 4)),
+                # По умолчанию клиент запрашивает msgpack и разбирает ответ целиком, минуя чтение
+                # порциями (chunked=True); с JSON каждая порция читается и отдается отдельно
+                headers={'Accept': 'application/json'},
+            )
+        return _influx_client
+
+
+# Измерения, границы которых запрашиваются и кэшируются вместе (ступени — по vusers, время теста — по response_time)
+_BOUNDS_MEASUREMENTS = ("es_tr_runtime_vusers", "es_tr_response_time")
+
+# Границы прогонов: {run_id: ({measurement: (начало, конец) в мс или None}, время получения)}
+_test_bounds_cache = {}
+_test_bounds_lock = threading.Lock()
+
+# Статистики по стадиям: {(run_id, ((начало, конец), ...)): (DataFrame, время получения)}
+_stage_statistics_cache = {}
+_stage_statistics_lock = threading.Lock()
+
+
+def close_influx_client():
+    """Закрывает общий клиент InfluxDB (например, при остановке процесса)."""
+    global _influx_client
+    with _influx_client_lock:
+        if _influx_client is not None:
+            _influx_client.close()
+            _influx_client = None
+
+
+def iter_influx_frames(query, measurement, chunk_size=None, params=None):
+    """
+    Выполняет запрос к InfluxDB с потоковой выдачей результата порциями (chunked=True).
+
+    :param query: str, запрос InfluxQL
+    :param measurement: str, измерение, точки которого нужно получить
+    :param chunk_size: int, точек в порции (по умолчанию CONFIG['influxdb']['chunk_size'])
+    :param params: dict, дополнительные параметры запроса (например, {'epoch': 'ms'})
+    :return: генератор DataFrame, по одному на порцию
+    """
+    if chunk_size is None:
+        chunk_size = int(CONFIG.get('influxdb', {}).get('chunk_size', 10000))
+    for result in get_influx_client().query(query, params=params or {}, chunked=True, chunk_size=chunk_size):
+        points = list(result.get_points(measurement=measurement))
+        if points:
+            yield pd.DataFrame(points)
+
+
+def query_influx_post(query, params=None):
+    """
+    Выполняет запрос InfluxQL методом POST с текстом запроса в теле (form-urlencoded).
+
+    InfluxDBClient.query передает текст запроса в параметре URL даже при method="POST",
+    поэтому длинные запросы (много выражений) упираются в ограничения длины URL прокси.
+
+    :param query: str, запрос InfluxQL (одно или несколько выражений через ';')
+    :param params: dict, дополнительные параметры URL (например, {'epoch': 'ms'})
+    :return: list ResultSet, по одному на выражение
+    """
+    client = get_influx_client()
+    url_params = dict(params or {})
+    url_params['db'] = CONFIG.get('influxdb', {}).get('database', 'test')
+    response = client.request(
+        'query',
+        method='POST',
+        params=url_params,
+        data=urlencode({'q': query}),
+        headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/json'},
+    )
+    return [ResultSet(result, raise_errors=True) for result in response.json().get('results', [])]
 
 
 def mergeDataframes(frames):
     """
     Объединяет список датафреймов в один датафрейм по столбцу 'transaction_name'.
 
+    Каждый датафрейм индексируется по transaction_name, и все они объединяются одним
+    pd.concat(axis=1) (внешнее объединение, ключи по возрастанию, как у pd.merge(how="outer"))
+    без копирования растущего результата на каждом шаге.
+
     :param frames: список датафреймов для объединения
     :return: объединенный датафрейм
     """
     try:
-        df = frames[0]
-        for i in range(1, len(frames)):
-            df = pd.merge(how="outer", left=df, right=frames[i], on='transaction_name')
-        return df
+        indexed = [frame.set_index('transaction_name') for frame in frames]
+        df = pd.concat(indexed, axis=1, join='outer', sort=True)
+        df.index.name = 'transaction_name'
+        return df.reset_index()
     except Exception as e:
         print(f"Error merging dataframes: {e}")
         return None
 
 
-import pandas as pd
+# Статистики времени отклика по стадиям: столбец результата get_lr_stage_statistics -> префикс столбца таблицы
+_STAGE_TABLE_COLUMNS = {
+    "response": [("mean", "mean_response_time")],
+    "count": [("count", "count")],
+    "percentile": [("p90", "percentile_90_response_time")],
+    "minmaxavg": [("min", "min"), ("mean", "avg"), ("max", "max")],
+}
+
+# Столбцы таблиц по стадиям, которые сравниваются с SLA по времени отклика
+# (шаблоны подходят и к широкой таблице — столбцы '<префикс>_step N', и к длинной — столбцы '<префикс>')
+_STAGE_TABLE_SLA_COLUMNS = {
+    "response": ["mean_response_time*"],
+    "percentile": ["percentile_90_response_time*"],
+    "minmaxavg": ["avg*"],
+}
+
+
+def _influx_time(timestamp_ms):
+    """Время в миллисекундах -> строка времени InfluxDB (с тем же сдвигом -3 ч, что и в запросах по стадиям)."""
+    return datetime.fromtimestamp(int(timestamp_ms) / 1000 - 3600 * 3).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def aggregate_response_time(run_id, start_time, end_time):
+    """
+    Считает по транзакциям количество, среднее, минимум и максимум времени отклика за интервал,
+    читая точки порциями и агрегируя на лету: память не растет с длиной теста.
+
+    :param run_id: идентификатор тестового прогона
+    :param start_time: начальное время интервала в миллисекундах
+    :param end_time: конечное время интервала в миллисекундах
+    :return: DataFrame (transaction_name, count, mean, min, max), отсортированный по transaction_name
+    """
+    query = (f"SELECT \"MeasurementName\", \"value\" FROM es_tr_response_time WHERE QcRunId = '{run_id}' "
+             f"AND time >= '{_influx_time(start_time)}' AND time <= '{_influx_time(end_time)}'")
+    totals = None
+    for chunk in iter_influx_frames(query, "es_tr_response_time"):
+        partial = chunk.groupby("MeasurementName")["value"].agg(["count", "sum", "min", "max"])
+        if totals is None:
+            totals = partial
+        else:
+            combined = pd.concat([totals, partial])
+            totals = combined.groupby(level=0).agg({"count": "sum", "sum": "sum", "min": "min", "max": "max"})
+
+    if totals is None:
+        return pd.DataFrame(columns=["transaction_name", "count", "mean", "min", "max"])
+    totals["mean"] = totals["sum"] / totals["count"]
+    totals.index.name = "transaction_name"
+    return totals[["count", "mean", "min", "max"]].sort_index().reset_index()
+
+
+def get_lr_stage_statistics(run_id, stages):
+    """
+    Получает статистики времени отклика по транзакциям для всех стадий теста одним запросом к InfluxDB.
+
+    Агрегация выполняется на сервере: для каждой стадии — выражение
+    MEAN/COUNT/PERCENTILE(90)/MIN/MAX с GROUP BY "MeasurementName"; все выражения
+    отправляются одним запросом (POST, текст в теле запроса), сырые точки на клиент не передаются.
+    PERCENTILE в InfluxQL считается по ближайшему рангу, без интерполяции.
+    Результат кэшируется по (run_id, стадии) на stage_statistics_cache_ttl_sec, поэтому
+    get_lr_*_from_influx для одного прогона выполняют один запрос на всех.
+
+    :param run_id: идентификатор тестового прогона
+    :param stages: список стадий теста с временем начала и окончания каждой стадии (мс);
+                   None — ступени определяются по прогону (get_test_time_steps)
+    :return: DataFrame (transaction_name, stage, mean, count, p90, min, max), stage — 'step <номер стадии>'
+    """
+    columns = ["transaction_name", "stage", "mean", "count", "p90", "min", "max"]
+    if stages is None:
+        stages = get_test_time_steps(run_id)
+    if not stages:
+        return pd.DataFrame(columns=columns)
+
+    influx_cfg = CONFIG.get('influxdb', {})
+    key = (str(run_id), tuple((int(stage[0]), int(stage[1])) for stage in stages))
+    ttl = float(influx_cfg.get('stage_statistics_cache_ttl_sec', 300))
+    with _stage_statistics_lock:
+        cached = _stage_statistics_cache.get(key)
+        if cached and time.time() - cached[1] < ttl:
+            return cached[0].copy()
+
+    statements = [
+        'SELECT MEAN("value") AS "mean", COUNT("value") AS "count", PERCENTILE("value", 90) AS "p90", '
+        'MIN("value") AS "min", MAX("value") AS "max" FROM "es_tr_response_time" '
+        f"WHERE \"QcRunId\" = '{run_id}' AND time >= '{_influx_time(stage[0])}' AND time <= '{_influx_time(stage[1])}' "
+        'GROUP BY "MeasurementName"'
+        for stage in stages
+    ]
+
+    # По выражению на стадию: при многих стадиях запрос длинный, поэтому он передается в теле POST, а не в URL
+    results = query_influx_post("; ".join(statements))
+
+    rows = []
+    for i, result in enumerate(results):
+        for (_, tags), points in result.items():
+            for point in points:
+                rows.append([
+                    tags["MeasurementName"], 'step ' + str(i),
+                    point["mean"], point["count"], point["p90"], point["min"], point["max"]
+                ])
+    statistics = pd.DataFrame(rows, columns=columns)
+    # Статистики незавершенной стадии (конец моложе bounds_settle_sec) еще меняются — не кэшируем
+    settle_sec = float(influx_cfg.get('bounds_settle_sec', 300))
+    if time.time() * 1000 - max(end for _, end in key[1]) >= settle_sec * 1000:
+        with _stage_statistics_lock:
+            _stage_statistics_cache[key] = (statistics, time.time())
+    return statistics.copy()
+
+
+def build_stage_table(statistics, table):
+    """
+    Строит широкую таблицу по стадиям: строка — транзакция, столбцы — '<статистика>_step N' для каждой стадии.
+
+    Кадр каждой стадии индексируется по transaction_name, все стадии объединяются одним pd.concat(axis=1).
+
+    :param statistics: DataFrame из get_lr_stage_statistics
+    :param table: str, вид таблицы: response, count, percentile или minmaxavg
+    :return: DataFrame (transaction_name, столбцы стадий) или None, если данных нет
+    """
+    frames = []
+    for stage, stage_df in statistics.groupby("stage", sort=False):
+        frame = stage_df.set_index("transaction_name")[[stat for stat, _ in _STAGE_TABLE_COLUMNS[table]]]
+        frame.columns = [prefix + '_' + stage for _, prefix in _STAGE_TABLE_COLUMNS[table]]
+        frames.append(frame)
+    if not frames:
+        return None
+
+    wide = pd.concat(frames, axis=1, join='outer', sort=True).round(4)
+    wide.index.name = "transaction_name"
+    return wide.reset_index()
+
+
+def build_stage_table_long(statistics, table):
+    """
+    Строит таблицу по стадиям в длинном формате: строка — пара (транзакция, стадия),
+    столбцы — статистики таблицы. Широкие промежуточные кадры не создаются,
+    поэтому формат подходит для прогонов с большим числом стадий.
+
+    :param statistics: DataFrame из get_lr_stage_statistics
+    :param table: str, вид таблицы: response, count, percentile или minmaxavg
+    :return: DataFrame (transaction_name, stage, статистики) или None, если данных нет
+    """
+    if statistics.empty:
+        return None
+    stats = _STAGE_TABLE_COLUMNS[table]
+    long_df = statistics[["transaction_name", "stage"] + [stat for stat, _ in stats]]
+    long_df = long_df.set_axis(["transaction_name", "stage"] + [prefix for _, prefix in stats], axis=1)
+    # Устойчивая сортировка сохраняет порядок стадий внутри транзакции
+    return long_df.sort_values("transaction_name", kind="stable").round(4).reset_index(drop=True)
+
+
+def _stage_table_storage(statistics, table, sla=None, layout=None):
+    """
+    Строит таблицу по стадиям из результата get_lr_stage_statistics и преобразует ее в формат Confluence Storage.
+
+    :param statistics: DataFrame из get_lr_stage_statistics
+    :param table: str, вид таблицы: response, count, percentile или minmaxavg
+    :param sla: float, порог времени отклика; ячейки времени отклика выше порога подсвечиваются (опционально)
+    :param layout: str, 'wide' (стадии — столбцы) или 'long' (стадии — строки);
+                   по умолчанию CONFIG['influxdb']['stage_table_layout']
+    :return: таблица в формате Confluence Storage или None, если данных нет
+    """
+    if layout is None:
+        layout = CONFIG.get('influxdb', {}).get('stage_table_layout', 'wide')
+    if layout == 'long':
+        stage_table = build_stage_table_long(statistics, table)
+    else:
+        stage_table = build_stage_table(statistics, table)
+    if stage_table is None:
+        return None
+
+    highlight = None
+    if sla is not None:
+        highlight = {pattern: sla for pattern in _STAGE_TABLE_SLA_COLUMNS.get(table, [])}
+    return ('<p class="auto-cursor-target"><br/></p> '
+            '<table> '
+            '<colgroup><col/><col/></colgroup>'
+            '<tbody> ' + dataframeToConfluence(stage_table, highlight=highlight) + ' </tbody> '
+            '</table> '
+            '<p><br/></p>')
+
+
+def get_lr_stage_tables(run_id, stages, sla=None, layout=None):
+    """
+    Строит все четыре таблицы по стадиям (среднее, количество, 90-й перцентиль, мин/сред/макс)
+    из одного агрегирующего запроса к InfluxDB.
+
+    :param run_id: идентификатор тестового прогона
+    :param stages: список стадий теста с временем начала и окончания каждой стадии
+    :param sla: float, порог времени отклика для подсветки нарушений SLA (опционально)
+    :param layout: str, 'wide' или 'long' (см. _stage_table_storage)
+    :return: dict {response, count, percentile, minmaxavg: таблица в формате Confluence Storage или None}
+    """
+    try:
+        statistics = get_lr_stage_statistics(run_id, stages)
+        return {table: _stage_table_storage(statistics, table, sla=sla, layout=layout) for table in _STAGE_TABLE_COLUMNS}
+    except Exception as e:
+        print(f"Error getting LR stage statistics from InfluxDB: {e}")
+        return {table: None for table in _STAGE_TABLE_COLUMNS}
+
 
 def get_lr_response_from_influx(run_id, stages):
     """
@@ -34,35 +335,12 @@ def get_lr_response_from_influx(run_id, stages):
     :return: данные ответа нагрузочного теста в формате Confluence Storage
     """
     try:
-        frames = []
-        i = 0
-        for stage in stages:
-            start_time = str(int(stage[0]))
-            end_time = str(int(stage[1]))
-            df = getLRResponseFromInflux(run_id, start_time, end_time, 'step ' + str(i))
-            if df is not None:
-                frames.append(df)
-            i += 1
-
-        merged_df = mergeDataframes(frames)
-        if merged_df is not None:
-            storage = ('<p class="auto-cursor-target"><br/></p> '
-                       '<table> '
-                       '<colgroup><col/><col/></colgroup>'
-                       '<tbody> ' + dataframeToConfluence(merged_df) + ' </tbody> '
-                       '</table> '
-                       '<p><br/></p>')
-            return storage
-        else:
-            return None
+        return _stage_table_storage(get_lr_stage_statistics(run_id, stages), "response")
     except Exception as e:
         print(f"Error getting LR response from InfluxDB: {e}")
         return None
 
 
-
-import pandas as pd
-
 def get_lr_count_from_influx(run_id, stages):
     """
     Получает количество выполненных транзакций нагрузочного теста из InfluxDB для каждой стадии теста,
@@ -73,33 +351,12 @@ def get_lr_count_from_influx(run_id, stages):
     :return: количество выполненных транзакций нагрузочного теста в формате Confluence Storage
     """
     try:
-        frames = []
-        i = 0
-        for stage in stages:
-            start_time = str(int(stage[0]))
-            end_time = str(int(stage[1]))
-            df = getLRCountFromInflux(run_id, start_time, end_time, 'step ' + str(i))
-            if df is not None:
-                frames.append(df)
-            i += 1
-
-        merged_df = mergeDataframes(frames)
-        if merged_df is not None:
-            storage = ('<p class="auto-cursor-target"><br/></p> '
-                       '<table> '
-                       '<colgroup><col/><col/></colgroup>'
-                       '<tbody> ' + dataframeToConfluence(merged_df) + ' </tbody> '
-                       '</table> '
-                       '<p><br/></p>')
-            return storage
-        else:
-            return None
+        return _stage_table_storage(get_lr_stage_statistics(run_id, stages), "count")
     except Exception as e:
         print(f"Error getting LR count from InfluxDB: {e}")
         return None
 
 
-
 def get_lr_percentile_from_influx(run_id, stages):
     """
     Получает процентили времени отклика нагрузочного теста из InfluxDB для каждой стадии теста,
@@ -110,27 +367,7 @@ def get_lr_percentile_from_influx(run_id, stages):
     :return: процентили времени отклика нагрузочного теста в формате Confluence Storage
     """
     try:
-        frames = []
-        i = 0
-        for stage in stages:
-            start_time = str(int(stage[0]))
-            end_time = str(int(stage[1]))
-            df = getLRPercentileFromInflux(run_id, start_time, end_time, 'step ' + str(i))
-            if df is not None:
-                frames.append(df)
-            i += 1
-
-        merged_df = mergeDataframes(frames)
-        if merged_df is not None:
-            storage = ('<p class="auto-cursor-target"><br/></p> '
-                       '<table> '
-                       '<colgroup><col/><col/></colgroup>'
-                       '<tbody> ' + dataframeToConfluence(merged_df) + ' </tbody> '
-                       '</table> '
-                       '<p><br/></p>')
-            return storage
-        else:
-            return None
+        return _stage_table_storage(get_lr_stage_statistics(run_id, stages), "percentile")
     except Exception as e:
         print(f"Error getting LR percentiles from InfluxDB: {e}")
         return None
@@ -146,27 +383,7 @@ def get_lr_MINMAXAVG_from_influx(run_id, stages):
     :return: минимальное, максимальное и среднее время отклика нагрузочного теста в формате Confluence Storage
     """
     try:
-        frames = []
-        i = 0
-        for stage in stages:
-            start_time = str(int(stage[0]))
-            end_time = str(int(stage[1]))
-            df = getLRResponseMINMAXAVGFromInflux(run_id, start_time, end_time, 'step ' + str(i))
-            if df is not None:
-                frames.append(df)
-            i += 1
-
-        merged_df = mergeDataframes(frames)
-        if merged_df is not None:
-            storage = ('<p class="auto-cursor-target"><br/></p> '
-                       '<table> '
-                       '<colgroup><col/><col/></colgroup>'
-                       '<tbody> ' + dataframeToConfluence(merged_df) + ' </tbody> '
-                       '</table> '
-                       '<p><br/></p>')
-            return storage
-        else:
-            return None
+        return _stage_table_storage(get_lr_stage_statistics(run_id, stages), "minmaxavg")
     except Exception as e:
         print(f"Error getting LR MIN/MAX/AVG from InfluxDB: {e}")
         return None
@@ -185,30 +402,14 @@ def getLRResponseFromInflux(run_id, start_time, end_time, step):
     :return: DataFrame с средним временем отклика для каждой транзакции
     """
     try:
-        # Подключение к базе данных InfluxDB
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
-
-        # Преобразование start_time и end_time из миллисекунд в строки формата InfluxDB
-        start_time_str = datetime.fromtimestamp((((int(start_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-        end_time_str = datetime.fromtimestamp((((int(end_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-
-        # Запрос данных по тесту
-        query = f"SELECT * FROM es_tr_response_time WHERE QcRunId = '{run_id}' AND time >= '{start_time_str}' AND time <= '{end_time_str}'"
-        result = client.query(query)
-
-        # Конвертирование результатов в pandas DataFrame
-        dataframe = pd.DataFrame(result["es_tr_response_time"]).rename(
-            columns={"MeasurementName": "transaction_name"})
-
-        # Группировка данных по названию транзакции
-        grouped_dataframe = dataframe.groupby("transaction_name")
+        # Потоковая агрегация по транзакциям (aggregate_response_time)
+        summary = aggregate_response_time(run_id, start_time, end_time)
+        if summary.empty:
+            return None
 
         # Расчет статистик: среднее значение
-        mean_dataframe = grouped_dataframe["value"].mean().reset_index().rename(
-            columns={"value": "mean_response_time" + '_' + step})
+        mean_dataframe = summary[["transaction_name", "mean"]].rename(
+            columns={"mean": "mean_response_time" + '_' + step})
         mean_dataframe["mean_response_time" + '_' + step] = mean_dataframe["mean_response_time" + '_' + step].round(4)
 
         return mean_dataframe[['transaction_name', 'mean_response_time' + '_' + step]]
@@ -222,6 +423,7 @@ def getLRResponseFromInflux(run_id, start_time, end_time, step):
 def getLRPercentileFromInflux(run_id, start_time, end_time, step):
     """
     Получает 90-й перцентиль времени отклика тестов из InfluxDB для заданного временного интервала.
+    Перцентиль считается на стороне InfluxDB (PERCENTILE по ближайшему рангу), точки на клиент не передаются.
 
     :param run_id: идентификатор тестового прогона
     :param start_time: начальное время интервала в миллисекундах
@@ -230,30 +432,23 @@ def getLRPercentileFromInflux(run_id, start_time, end_time, step):
     :return: DataFrame с 90-м перцентилем времени отклика для каждой транзакции
     """
     try:
-        # Подключение к базе данных InfluxDB
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
-
-        # Преобразование start_time и end_time из миллисекунд в строки формата InfluxDB
-        start_time_str = datetime.fromtimestamp((((int(start_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-        end_time_str = datetime.fromtimestamp((((int(end_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-
-        # Запрос данных по тесту
-        query = f"SELECT * FROM es_tr_response_time WHERE QcRunId = '{run_id}' AND time >= '{start_time_str}' AND time <= '{end_time_str}'"
-        result = client.query(query)
-
-        # Конвертирование результатов в pandas DataFrame
-        dataframe = pd.DataFrame(result["es_tr_response_time"]).rename(
-            columns={"MeasurementName": "transaction_name"})
-
-        # Группировка данных по названию транзакции
-        grouped_dataframe = dataframe.groupby("transaction_name")
+        # Запрос перцентиля по транзакциям
+        query = (f"SELECT PERCENTILE(\"value\", 90) AS \"p90\" FROM es_tr_response_time WHERE QcRunId = '{run_id}' "
+                 f"AND time >= '{_influx_time(start_time)}' AND time <= '{_influx_time(end_time)}' GROUP BY \"MeasurementName\"")
+        result = get_influx_client().query(query)
+
+        rows = [
+            [tags["MeasurementName"], point["p90"]]
+            for (_, tags), points in result.items()
+            for point in points
+        ]
+        if not rows:
+            return None
 
         # Расчет статистик: 90 перцентиль
-        percentile_90_dataframe = grouped_dataframe["value"].quantile(0.9).reset_index().rename(
-            columns={"value": "percentile_90_response_time" + '_' + step})
+        percentile_90_dataframe = pd.DataFrame(
+            rows, columns=["transaction_name", "percentile_90_response_time" + '_' + step]
+        ).sort_values("transaction_name").reset_index(drop=True)
         percentile_90_dataframe["percentile_90_response_time" + '_' + step] = percentile_90_dataframe[
             "percentile_90_response_time" + '_' + step].round(4)
 
@@ -276,31 +471,14 @@ def getLRCountFromInflux(run_id, start_time, end_time, step):
     :return: DataFrame с количеством тестов для каждой транзакции
     """
     try:
-        # Подключение к базе данных InfluxDB
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
-
-        # Преобразование start_time и end_time из миллисекунд в строки формата InfluxDB
-        start_time_str = datetime.fromtimestamp((((int(start_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-        end_time_str = datetime.fromtimestamp((((int(end_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-
-        # Запрос данных по тесту
-        query = f"SELECT * FROM es_tr_response_time WHERE QcRunId = '{run_id}' AND time >= '{start_time_str}' AND time <= '{end_time_str}'"
-        result = client.query(query)
-
-        # Конвертирование результатов в pandas DataFrame
-        dataframe = pd.DataFrame(result["es_tr_response_time"]).rename(
-            columns={"MeasurementName": "transaction_name"})
-
-        # Группировка данных по названию транзакции
-        grouped_dataframe = dataframe.groupby("transaction_name")
+        # Потоковая агрегация по транзакциям (aggregate_response_time)
+        summary = aggregate_response_time(run_id, start_time, end_time)
+        if summary.empty:
+            return None
 
         # Расчет статистик: количество
-        count_dataframe = grouped_dataframe["value"].count().reset_index().rename(
-            columns={"value": "count" + '_' + step})
-        count_dataframe["count" + '_' + step] = count_dataframe["count" + '_' + step].round(4)
+        count_dataframe = summary[["transaction_name", "count"]].rename(
+            columns={"count": "count" + '_' + step})
 
         return count_dataframe[['transaction_name', 'count' + '_' + step]]
 
@@ -321,46 +499,16 @@ def getLRResponseMINMAXAVGFromInflux(run_id, start_time, end_time, step):
     :return: DataFrame с минимальным, максимальным и средним временем ответа для каждой транзакции
     """
     try:
-        # Подключение к базе данных InfluxDB
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
-
-        # Преобразование start_time и end_time из миллисекунд в строки формата InfluxDB
-        start_time_str = datetime.fromtimestamp((((int(start_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-        end_time_str = datetime.fromtimestamp((((int(end_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-
-        # Запрос данных по тесту
-        query = f"SELECT * FROM es_tr_response_time WHERE QcRunId = '{run_id}' AND time >= '{start_time_str}' AND time <= '{end_time_str}'"
-        result = client.query(query)
-
-        # Конвертирование результатов в pandas DataFrame
-        dataframe = pd.DataFrame(result["es_tr_response_time"]).rename(
-            columns={"MeasurementName": "transaction_name"})
-
-        # Группировка данных по названию транзакции
-        grouped_dataframe = dataframe.groupby("transaction_name")
+        # Потоковая агрегация по транзакциям (aggregate_response_time)
+        summary = aggregate_response_time(run_id, start_time, end_time)
+        if summary.empty:
+            return None
 
         # Расчет статистик: среднее значение, минимальное, максимальное
-        mean_dataframe = grouped_dataframe["value"].mean().reset_index().rename(
-            columns={"value": "mean_response_time"})
-        min_dataframe = grouped_dataframe["value"].min().reset_index().rename(
-            columns={"value": "min_response_time"})
-        max_dataframe = grouped_dataframe["value"].max().reset_index().rename(
-            columns={"value": "max_response_time"})
-
-        mean_dataframe["mean_response_time"] = mean_dataframe["mean_response_time"].round(4)
-        min_dataframe["min_response_time"] = min_dataframe["min_response_time"].round(4)
-        max_dataframe["max_response_time"] = max_dataframe["max_response_time"].round(4)
-
-        # Объединение результатов в один DataFrame
-        summary_dataframe = pd.merge(mean_dataframe, min_dataframe, on="transaction_name")
-        summary_dataframe = pd.merge(summary_dataframe, max_dataframe, on="transaction_name")
-
-        summary_dataframe = summary_dataframe.rename(
-            columns={"mean_response_time": "avg" + '_' + step, "min_response_time": "min" + '_' + step,
-                     "max_response_time": "max" + '_' + step})
+        summary_dataframe = summary.rename(
+            columns={"mean": "avg" + '_' + step, "min": "min" + '_' + step, "max": "max" + '_' + step})
+        for column in ("min" + '_' + step, "avg" + '_' + step, "max" + '_' + step):
+            summary_dataframe[column] = summary_dataframe[column].round(4)
 
         return summary_dataframe[['transaction_name', "min" + '_' + step, "avg" + '_' + step, "max" + '_' + step]]
     except Exception as e:
@@ -382,31 +530,12 @@ def getTransactionFromInflux(run_id, start_time, end_time):
     :return: DataFrame с названиями транзакций
     """
     try:
-        # Подключение к базе данных InfluxDB
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
-
-        # Преобразование start_time и end_time из миллисекунд в строки формата InfluxDB
-        start_time_str = datetime.fromtimestamp((((int(start_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-        end_time_str = datetime.fromtimestamp((((int(end_time) / 1000) - 3600 * 3) * 1000) / 1000).strftime(
-            '%Y-%m-%dT%H:%M:%SZ')
-
-        # Запрос данных по тесту
-        query = f"SELECT * FROM es_tr_response_time WHERE QcRunId = '{run_id}' AND time >= '{start_time_str}' AND time <= '{end_time_str}'"
-        result = client.query(query)
-
-        # Конвертирование результатов в pandas DataFrame
-        dataframe = pd.DataFrame(result["es_tr_response_time"]).rename(
-            columns={"MeasurementName": "transaction_name"})
-
-        # Группировка данных по названию транзакции
-        grouped_dataframe = dataframe.groupby("transaction_name")
-
-        # Расчет статистик: количество
-        count_dataframe = grouped_dataframe["value"].count().reset_index()
+        # Потоковая агрегация по транзакциям (aggregate_response_time)
+        summary = aggregate_response_time(run_id, start_time, end_time)
+        if summary.empty:
+            return None
 
-        count_dataframe.rename({'transaction_name': 'Operation'}, axis=1, inplace=True)
+        count_dataframe = summary.rename({'transaction_name': 'Operation'}, axis=1)
         count_dataframe = count_dataframe["Operation"]
         count_dataframe = count_dataframe.to_numpy()
 
@@ -419,105 +548,104 @@ def getTransactionFromInflux(run_id, start_time, end_time):
 
 
 
-def dataframeToConfluence(df):
+def dataframeToConfluence(df, formats=None, highlight=None):
 
     """
     Конвертирует DataFrame в вид подходящий для добавления в Confluence.
 
     :param df: исходный DataFrame
+    :param formats: dict {столбец или шаблон: формат значения}, см. confluence_manager.storage_table
+    :param highlight: dict {столбец или шаблон: порог SLA или callable}, подсветка нарушений
     :return: String сданными из DataFrame
     """
     try:
-        # Инициализация переменных
-        columns = []
-        columnsName = '<tr>'
-
-        # Формирование строки с названиями столбцов
-        for column in df.columns:
-            columns.append(column)
-            columnsName = str(columnsName) + '<th>' + str(column) + '</th>'
-        columnsName = columnsName + '</tr>'
-
-        # Формирование строк с данными
-        columnsData = ''
-        for index, row in df.iterrows():
-            columnsData = columnsData + '<tr>'
-            for column1 in columns:
-                columnsData = str(columnsData) + '<td>' + str(row[column1]) + '</td>'
-            columnsData = str(columnsData) + '</tr>'
-
-        # Объединение названий столбцов и данных
-        columnsData = columnsName + columnsData
-
-        return columnsData
+        # Строка заголовков и строки данных формируются за один проход по столбцам
+        return render_table_rows(df, formats=formats, highlight=highlight, na_rep=None)
     except Exception as e:
         print(f"Ошибка при преобразовании DataFrame в HTML-таблицу для Confluence: {e}")
         return None
 
 
+def detect_test_steps(points, min_duration_sec=1100, align_sec=300):
+    """
+    Находит ступени нагрузки по ряду числа виртуальных пользователей (векторно, без обхода точек).
 
+    Ступень — серия подряд идущих точек с одинаковым числом пользователей; она длится от первой
+    точки серии до первой точки следующей (последняя — до последней точки ряда). Остаются ступени
+    длиннее min_duration_sec, каждая симметрично обрезается до длительности, кратной align_sec.
 
-def get_test_time_steps(run_id):
+    :param points: DataFrame со столбцами time (мс) и value (число пользователей), упорядоченный по времени
+    :param min_duration_sec: минимальная длительность ступени в секундах
+    :param align_sec: кратность длительности ступени в секундах
+    :return: DataFrame (TimeStepStart, CountOfUsers, TimeStepEnd, Duration, sec)
+    """
+    columns = ['TimeStepStart', 'CountOfUsers', 'TimeStepEnd', 'Duration, sec']
+    if points.empty:
+        return pd.DataFrame(columns=columns)
+
+    times = points['time'].to_numpy(dtype='int64')
+    users = points['value'].to_numpy(dtype='float64').astype('int64')
+
+    # Точки смены числа пользователей: начало каждой ступени
+    change = np.empty(len(users), dtype=bool)
+    change[0] = True
+    change[1:] = np.diff(users) != 0
+    starts_idx = np.flatnonzero(change)
+
+    step_start = times[starts_idx].astype('float64')
+    step_end = np.append(times[starts_idx[1:]], times[-1]).astype('float64')
+    duration = (step_end - step_start) / 1000
+
+    keep = duration > min_duration_sec
+    step_start, step_end, duration = step_start[keep], step_end[keep], duration[keep]
+
+    # Обрезка до кратности align_sec: по половине остатка с каждой стороны
+    # (при нечетном остатке начало сдвигается на лишнюю секунду)
+    difference = duration % align_sec * 1000
+    step_start = step_start + difference / 2 + np.where(difference % 2 == 0, 0, 1000)
+    step_end = step_end - difference / 2
+
+    return pd.DataFrame({
+        'TimeStepStart': step_start,
+        'CountOfUsers': users[starts_idx][keep],
+        'TimeStepEnd': step_end,
+        'Duration, sec': (step_end - step_start) / 1000,
+    }, columns=columns)
+
+
+def get_test_time_steps(run_id, downsample=None):
     """
     Получает временные интервалы по каждой ступени теста из InfluxDB для заданного идентификатора тестового прогона.
 
     :param run_id: идентификатор тестового прогона
+    :param downsample: str, интервал прореживания на стороне InfluxDB (например, '10s'): вместо всех точек
+                       передается последнее значение в каждом интервале GROUP BY time(); границы ступеней
+                       определяются с точностью до интервала (по умолчанию CONFIG['influxdb']['steps_downsample'])
     :return: DataFrame с  временем начала и окончания каждой ступени теста
     """
     try:
         print("Method getInfluxDatetimeOfSteps starts")
 
-        # Подключение к базе данных InfluxDB
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
+        if downsample is None:
+            downsample = CONFIG.get('influxdb', {}).get('steps_downsample')
 
-        # Запрос данных о временных шагах теста
-        query_full_test = f"SELECT * FROM es_tr_runtime_vusers WHERE QcRunId = '{run_id}';"
-        result_full_test = client.query(query_full_test, params={'epoch': 'ms'})
-
-        steps = []
-        points = list(result_full_test.get_points())
-
-        users = 0
-        i = 0
-        for index, item in enumerate(points):
-            if index == 0:
-                users = int(item['value'])
-                steps.append([item['time'], users])
-                i += 1
-                continue
-
-            current_users = int(item['value'])
+        # Границы прогона (кэшируются): ограничивают запрос и сетку интервалов GROUP BY time()
+        bounds = get_test_bounds(run_id, "es_tr_runtime_vusers")
+        if bounds is None:
+            return []
+        time_filter = f"time >= {bounds[0]}ms AND time <= {bounds[1]}ms"
 
-            if current_users != users:
-                users = current_users
-                steps[i - 1].append(item['time'])
-                steps.append([item['time'], users])
-                i += 1
-
-            if index == len(points) - 1 and current_users == users:
-                steps[i - 1].append(item['time'])
-                steps.append([item['time'], users])
-                continue
-
-        client.close()
-
-        df = pd.DataFrame(steps, columns=['TimeStepStart', 'CountOfUsers', 'TimeStepEnd'])
-        df['Duration, sec'] = (df['TimeStepEnd'] - df['TimeStepStart']) / 1000
-        steps_array = df[df['Duration, sec'] > 1100]
-        steps_array.reset_index(drop=True, inplace=True)
+        # Запрос данных о временных шагах теста
+        if downsample:
+            query_full_test = (f"SELECT LAST(\"value\") AS \"value\" FROM es_tr_runtime_vusers WHERE QcRunId = '{run_id}' "
+                               f"AND {time_filter} GROUP BY time({downsample}) fill(none)")
+        else:
+            query_full_test = f"SELECT \"value\" FROM es_tr_runtime_vusers WHERE QcRunId = '{run_id}' AND {time_filter}"
 
-        for i in range(len(steps_array.index)):
-            difference = steps_array.iloc[i, 3] % 300 * 1000
+        frames = list(iter_influx_frames(query_full_test, "es_tr_runtime_vusers", params={'epoch': 'ms'}))
+        points = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['time', 'value'])
 
-            if (difference % 2 == 0):
-                steps_array.iloc[i, 0] += difference / 2
-                steps_array.iloc[i, 2] -= difference / 2
-                steps_array.iloc[i, 3] = (steps_array.iloc[i, 2] - steps_array.iloc[i, 0]) / 1000
-            else:
-                steps_array.iloc[i, 0] += (difference / 2 + 1000)
-                steps_array.iloc[i, 2] -= difference / 2
-                steps_array.iloc[i, 3] = (steps_array.iloc[i, 2] - steps_array.iloc[i, 0]) / 1000
+        steps_array = detect_test_steps(points)
 
         steps = steps_array[['TimeStepStart', 'TimeStepEnd']].values.tolist()
 
@@ -530,35 +658,88 @@ def get_test_time_steps(run_id):
 
 
 
-def get_test_data_time(run_id):
+def _query_test_bounds(run_id, measurements):
+    """Время первой и последней точки прогона по каждому измерению — одним запросом FIRST()/LAST()."""
+    statements = []
+    for measurement in measurements:
+        statements.append(f'SELECT FIRST("value") FROM "{measurement}" WHERE "QcRunId" = \'{run_id}\'')
+        statements.append(f'SELECT LAST("value") FROM "{measurement}" WHERE "QcRunId" = \'{run_id}\'')
+    results = get_influx_client().query("; ".join(statements), params={'epoch': 'ms'})
+    if not isinstance(results, list):
+        results = [results]
+
+    bounds = {}
+    for i, measurement in enumerate(measurements):
+        first_points = list(results[2 * i].get_points())
+        last_points = list(results[2 * i + 1].get_points())
+        if first_points and last_points:
+            bounds[measurement] = (int(first_points[0]['time']), int(last_points[0]['time']))
+        else:
+            bounds[measurement] = None
+    return bounds
+
+
+def get_test_bounds(run_id, measurement="es_tr_response_time"):
     """
-    Получает временной интервал начала и окончания теста из InfluxDB для заданного идентификатора тестового прогона.
+    Возвращает время первой и последней точки прогона в измерении InfluxDB.
+
+    Используются выборки FIRST()/LAST() на стороне сервера, поэтому время ответа не зависит
+    от размера прогона. Границы всех измерений _BOUNDS_MEASUREMENTS запрашиваются одним
+    запросом и кэшируются по run_id на CONFIG['influxdb']['bounds_cache_ttl_sec'] секунд,
+    так что поиск ступеней, время теста и таблицы по стадиям используют один запрос.
+    Прогон, последняя точка которого моложе bounds_settle_sec, считается незавершенным
+    и не кэшируется (границы растут, пока тест идет).
 
     :param run_id: идентификатор тестового прогона
-    :return: DataFrame с временным интервалом начала и окончания теста
+    :param measurement: str, измерение InfluxDB
+    :return: tuple (начало, конец) в миллисекундах или None, если точек нет
     """
-    try:
-        # Замените значения ниже на соответствующие значения для вашей базы данных InfluxDB
-        measurement_name = "es_tr_response_time"
-        client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                                database='test')
-
-        # Запрос для получения всех данных для данного run_id
-        query = f'SELECT * FROM "{measurement_name}" WHERE "QcRunId" = \'{run_id}\''
-        result = client.query(query)
+    influx_cfg = CONFIG.get('influxdb', {})
+    key = str(run_id)
+    ttl = float(influx_cfg.get('bounds_cache_ttl_sec', 300))
+    with _test_bounds_lock:
+        cached = _test_bounds_cache.get(key)
+        if cached and measurement in cached[0] and time.time() - cached[1] < ttl:
+            return cached[0][measurement]
+
+    measurements = list(_BOUNDS_MEASUREMENTS)
+    if measurement not in measurements:
+        measurements.append(measurement)
+    bounds = _query_test_bounds(run_id, measurements)
+
+    last_ms = max((b[1] for b in bounds.values() if b), default=None)
+    settle_sec = float(influx_cfg.get('bounds_settle_sec', 300))
+    if last_ms is not None and time.time() * 1000 - last_ms >= settle_sec * 1000:
+        with _test_bounds_lock:
+            _test_bounds_cache[key] = (bounds, time.time())
+    return bounds[measurement]
+
+
+def invalidate_test_bounds(run_id=None):
+    """Сбрасывает кэши границ и статистик по стадиям прогона run_id (None — всех прогонов), например после дозаписи данных."""
+    with _test_bounds_lock:
+        if run_id is None:
+            _test_bounds_cache.clear()
+        else:
+            _test_bounds_cache.pop(str(run_id), None)
+    with _stage_statistics_lock:
+        for key in list(_stage_statistics_cache):
+            if run_id is None or key[0] == str(run_id):
+                del _stage_statistics_cache[key]
 
-        points = list(result.get_points())
 
-        if points:
-            # Преобразование данных в DataFrame
-            df = pd.DataFrame(points)
+def get_test_data_time(run_id):
+    """
+    Получает временной интервал начала и окончания теста из InfluxDB для заданного идентификатора тестового прогона.
 
-            # Нахождение времени начала и окончания теста
-            start_time = df['time'].min()
-            end_time = df['time'].max()
+    :param run_id: идентификатор тестового прогона
+    :return: список [начало, окончание] теста в секундах
+    """
+    try:
+        bounds = get_test_bounds(run_id)
 
-            start_time = int(pd.to_datetime(start_time).timestamp())
-            end_time = int(pd.to_datetime(end_time).timestamp())
+        if bounds:
+            start_time, end_time = bounds[0] // 1000, bounds[1] // 1000
             test_time = [start_time, end_time]
 
             print(f"Start time: {start_time}, End time: {end_time}")
@@ -578,12 +759,11 @@ def getTransactionsByRunID(project, runID, transactions_filter):
 
     # Initializing the LRE params of the project
     # host, port, username, password, dbname = initLREParam(project)
-    client = InfluxDBClient(host='rbqacas00004.gts.rus.socgen', port=8086, username='pcuser', password='pcuser',
-                            database='test')
+    client = get_influx_client()
 
 
     # client = InfluxDBClient(host, port, username, password, dbname)
-    allSeries = client.get_list_series(database='test', measurement='es_tr_response_time', tags={'QcRunId': runID})
+    allSeries = client.get_list_series(database=CONFIG.get('influxdb', {}).get('database', 'test'), measurement='es_tr_response_time', tags={'QcRunId': runID})
     transactionsList = []
     for item in allSeries:
         # print(item)
@@ -604,7 +784,6 @@ def getTransactionsByRunID(project, runID, transactions_filter):
     print("We have the transactions list")
     # print(transactionsList)
 
-    client.close()
     transactionsList.sort()
 
     return transactionsList
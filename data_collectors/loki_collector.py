@@ -1,13 +1,160 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import gzip
+import html
+import io
 import os
+import queue
+import re
 import shutil
+import threading
 from requests.auth import HTTPBasicAuth
+from config import CONFIG
+from utils import http_client
+from confluence_manager.confluence_gateway import get_confluence_gateway
+
+try:
+    import zstandard  # опционально: сжатие логов в zstd
+except Exception:
+    zstandard = None
+
+
+# Расширения и MIME-типы сжатых архивов логов
+_ARCHIVE_TYPES = {
+    'gzip': ('.gz', 'application/gzip'),
+    'zstd': ('.zst', 'application/zstd'),
+}
+
+def loki_view_file_macro(attachment_name):
+    """Разметка Confluence для отображения вложенного файла логов виджетом view-file."""
+    return f'<ac:structured-macro ac:name="view-file" ac:schema-version="1"><ac:parameter ac:name="name"><ri:attachment ri:filename="{attachment_name}" /></ac:parameter><ac:parameter ac:name="height">250</ac:parameter></ac:structured-macro>'
+
+
+def loki_archive_macro(attachment_name, preview_lines):
+    """
+    Разметка Confluence для сжатого архива логов: первые строки лога в блоке кода
+    и ссылка на скачивание архива (view-file архивы не отображает).
+
+    :param attachment_name: str, имя вложения-архива
+    :param preview_lines: list, строки для предпросмотра
+    :return: str, разметка хранилища Confluence
+    """
+    preview = "\n".join(line.rstrip("\n") for line in preview_lines).replace("]]>", "]]]]><![CDATA[>")
+    return (
+        f'<ac:structured-macro ac:name="code" ac:schema-version="1">'
+        f'<ac:parameter ac:name="language">text</ac:parameter>'
+        f'<ac:parameter ac:name="title">Начало лога</ac:parameter>'
+        f'<ac:plain-text-body><![CDATA[{preview}]]></ac:plain-text-body></ac:structured-macro>'
+        f'<p><ac:link><ri:attachment ri:filename="{attachment_name}" />'
+        f'<ac:plain-text-link-body><![CDATA[Скачать полный лог ({attachment_name})]]></ac:plain-text-link-body></ac:link></p>'
+    )
+
+
+def _archive_format(file_path):
+    for fmt, (suffix, _) in _ARCHIVE_TYPES.items():
+        if file_path.endswith(suffix):
+            return fmt
+    return None
+
+
+def open_log_file(file_path):
+    """Открывает файл логов на чтение как текст, распаковывая .gz/.zst."""
+    fmt = _archive_format(file_path)
+    if fmt == 'gzip':
+        return gzip.open(file_path, 'rt', encoding='utf-8')
+    if fmt == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(file_path, 'r', encoding='utf-8')
+
+
+def log_attachment_content_type(file_path):
+    """MIME-тип вложения для файла логов (None — определяет Confluence)."""
+    fmt = _archive_format(file_path)
+    return _ARCHIVE_TYPES[fmt][1] if fmt else None
+
+
+def loki_attachment_macro(file_path, preview_lines=None):
+    """
+    Разметка для вложения логов с учетом формата: view-file для обычного .log,
+    предпросмотр первых строк и ссылка на скачивание для сжатого архива.
+
+    :param file_path: str, путь к файлу логов (имя вложения — имя файла)
+    :param preview_lines: int, строк в предпросмотре (по умолчанию CONFIG['loki']['compress']['preview_lines'])
+    """
+    attachment_name = os.path.basename(file_path)
+    if _archive_format(file_path) is None:
+        return loki_view_file_macro(attachment_name)
+    if preview_lines is None:
+        preview_lines = int(CONFIG.get('loki', {}).get('compress', {}).get('preview_lines', 50))
+    preview = []
+    with open_log_file(file_path) as file:
+        for line in file:
+            if len(preview) >= preview_lines:
+                break
+            preview.append(line)
+    return loki_archive_macro(attachment_name, preview)
+
+
+class LogFileWriter:
+    """
+    Запись файла логов с переходом на сжатие по размеру.
+
+    Пока записано меньше min_bytes, строки пишутся в обычный .log. При превышении
+    порога записанное переносится в архив (gzip или zstd) и дальнейшие строки
+    сжимаются потоком, так что несжатая копия большого лога на диске не хранится.
+    """
+
+    def __init__(self, file_path, compress_format=None, min_bytes=0):
+        if compress_format == 'zstd' and zstandard is None:
+            print("Пакет zstandard не установлен, логи сжимаются в gzip")
+            compress_format = 'gzip'
+        if compress_format not in _ARCHIVE_TYPES:
+            compress_format = None
+        self.file_path = file_path
+        self.compress_format = compress_format
+        self.min_bytes = min_bytes
+        self.written = 0
+        self.compressed = False
+        self._file = open(file_path, 'w', encoding='utf-8')
+
+    def write(self, text):
+        self._file.write(text)
+        self.written += len(text.encode('utf-8'))
+        if self.compress_format and not self.compressed and self.written > self.min_bytes:
+            self._switch_to_archive()
+
+    def _switch_to_archive(self):
+        plain_path = self.file_path
+        self._file.close()
+        suffix = _ARCHIVE_TYPES[self.compress_format][0]
+        archive_path = plain_path + suffix
+        if self.compress_format == 'gzip':
+            archive = gzip.open(archive_path, 'wt', encoding='utf-8')
+        else:
+            writer = zstandard.ZstdCompressor().stream_writer(open(archive_path, 'wb'), closefd=True)
+            archive = io.TextIOWrapper(writer, encoding='utf-8')
+        with open(plain_path, 'r', encoding='utf-8') as plain:
+            shutil.copyfileobj(plain, archive)
+        os.remove(plain_path)
+        self._file = archive
+        self.file_path = archive_path
+        self.compressed = True
+
+    def close(self):
+        self._file.close()
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
 
 # Функция для отправки логов как вложения на Confluence
-def send_loki_file_to_attachment(url_basic, auth, page_id, file_path):
+def send_loki_file_to_attachment(url_basic, auth, page_id, file_path, gateway=None):
     """
     Отправка файла логов как вложения на страницу Confluence.
+    При переданном gateway используется его общий пул соединений.
     """
     try:
         url = f"{url_basic}/rest/api/content/{page_id}/child/attachment"
@@ -20,14 +167,19 @@ def send_loki_file_to_attachment(url_basic, auth, page_id, file_path):
 
         # Загрузка файла как вложения
         with open(file_path, 'rb') as file:
-            files = {"file": file}
-            response = requests.post(
-                url,
-                files=files,
-                auth=auth,
-                headers={'X-Atlassian-Token': 'nocheck'},
-                verify=False
-            )
+            if gateway is not None:
+                response = gateway.upload_attachment(
+                    page_id, os.path.basename(file_path), file, log_attachment_content_type(file_path)
+                )
+            else:
+                files = {"file": file}
+                response = http_client.post(
+                    url,
+                    files=files,
+                    auth=auth,
+                    headers={'X-Atlassian-Token': 'nocheck'},
+                    verify=False
+                )
 
         # Проверка ответа от Confluence
         if response.status_code == 200 or response.status_code == 201:
@@ -41,52 +193,494 @@ def send_loki_file_to_attachment(url_basic, auth, page_id, file_path):
         return None
 
 
+def _to_ns(timestamp_ms):
+    """Метка времени в миллисекундах -> наносекунды (формат Loki)."""
+    return int(timestamp_ms) * 1_000_000
+
+
+def iter_loki_entries(loki_url, start_ns, end_ns, filter_query, page_limit=None, gaps=None):
+    """
+    Постранично читает логи из Loki в порядке возрастания времени.
+
+    Запросы query_range выполняются с direction=forward; курсором следующей страницы
+    служит время последней полученной записи (включительно), уже выданные записи
+    с этим временем пропускаются (запись определяется временем, строкой и метками потока).
+    Если в одной наносекунде записей больше, чем помещается на страницу, запрос повторяется
+    с удвоенным лимитом (до CONFIG['loki']['max_page_limit']); только если и этого мало,
+    остаток наносекунды пропускается с предупреждением и записью в gaps.
+    В памяти одновременно находится не больше одной страницы.
+
+    :param loki_url: str, endpoint Loki .../loki/api/v1/query_range
+    :param start_ns: int, начало диапазона в наносекундах
+    :param end_ns: int, конец диапазона в наносекундах
+    :param filter_query: str, LogQL-запрос
+    :param page_limit: int, записей на страницу (по умолчанию CONFIG['loki']['page_limit'])
+    :param gaps: list, сюда добавляются описания пропущенных записей (опционально)
+    :return: генератор пар (время в нс, строка лога); при ошибке HTTP выбрасывает RuntimeError
+    """
+    loki_cfg = CONFIG.get('loki', {})
+    if page_limit is None:
+        page_limit = int(loki_cfg.get('page_limit', 1000))
+    max_page_limit = max(page_limit, int(loki_cfg.get('max_page_limit', 5000)))
+
+    cursor = start_ns
+    limit = page_limit
+    # Записи с временем, равным курсору, которые уже выданы (граница страниц)
+    boundary_seen = set()
+
+    while cursor <= end_ns:
+        params = {
+            'query': filter_query,
+            'start': cursor,
+            'end': end_ns,
+            'limit': limit,
+            'direction': 'forward'
+        }
+        response = http_client.get(loki_url, params=params)
+        if response.status_code != 200:
+            raise RuntimeError(f"Ошибка при получении логов из Loki: {response.status_code} - {response.text}")
+
+        # Ключ записи включает метки потока: одинаковые строки с одним временем из разных
+        # потоков (подов) — разные записи и не должны схлопываться при пропуске границы
+        page = [
+            (int(timestamp), log, stream_key)
+            for stream in response.json()['data']['result']
+            for stream_key in [tuple(sorted((stream.get('stream') or {}).items()))]
+            for timestamp, log in stream['values']
+        ]
+        # Loki ограничивает страницу по времени, но не сортирует записи между потоками
+        page.sort(key=lambda entry: entry[0])
+
+        emitted = 0
+        for entry in page:
+            if entry[0] == cursor and entry in boundary_seen:
+                continue
+            emitted += 1
+            yield entry[0], entry[1]
+
+        if len(page) < limit:
+            return
+
+        last_ts = page[-1][0]
+        if last_ts == cursor:
+            boundary_seen.update(entry for entry in page if entry[0] == last_ts)
+            if emitted == 0:
+                # Вся страница — уже выданные записи с одним временем: повторяем наносекунду с большим лимитом
+                if limit < max_page_limit:
+                    limit = min(limit * 2, max_page_limit)
+                    continue
+                message = (f"в Loki не меньше {limit} записей с временем {cursor} нс, "
+                           f"часть из них могла быть пропущена (увеличьте max_page_limit)")
+                print(f"Предупреждение: {message}")
+                if gaps is not None:
+                    gaps.append(message)
+                cursor += 1
+                limit = page_limit
+                boundary_seen = set()
+        else:
+            cursor = last_ts
+            limit = page_limit
+            boundary_seen = {entry for entry in page if entry[0] == last_ts}
+
+
+def split_time_window(start_ns, end_ns, shards, min_shard_ns=0):
+    """
+    Делит диапазон [start_ns, end_ns] на не пересекающиеся подряд идущие шарды.
+
+    :param shards: int, желаемое число шардов
+    :param min_shard_ns: int, минимальная длина шарда; короткие окна делятся на меньшее число частей
+    :return: list, пары (начало, конец) включительно, в порядке времени
+    """
+    span = end_ns - start_ns + 1
+    if min_shard_ns > 0:
+        shards = min(shards, span // min_shard_ns)
+    shards = max(1, int(shards))
+    bounds = [start_ns + span * i // shards for i in range(shards + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(shards)]
+
+
+# Маркер конца шарда в очереди записей
+_SHARD_DONE = object()
+
+
+def _put_until_stopped(out, item, stop):
+    """Кладет item в ограниченную очередь, ожидая места; возвращает False, если чтение остановлено."""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _fetch_shard_to_queue(loki_url, start_ns, end_ns, filter_query, max_entries, out, stop, gaps=None):
+    """
+    Читает шард постранично и передает записи пачками по page_limit в очередь out.
+    Очередь ограничена, поэтому шард опережает чтение не больше чем на размер очереди;
+    после установки stop новые страницы не запрашиваются. Ошибка передается в очередь.
+    """
+    batch_size = int(CONFIG.get('loki', {}).get('page_limit', 1000))
+    batch = []
+    try:
+        for count, entry in enumerate(iter_loki_entries(loki_url, start_ns, end_ns, filter_query, gaps=gaps), start=1):
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                if not _put_until_stopped(out, batch, stop):
+                    return
+                batch = []
+            if count >= max_entries:
+                break
+        if batch and not _put_until_stopped(out, batch, stop):
+            return
+        _put_until_stopped(out, _SHARD_DONE, stop)
+    except Exception as e:
+        _put_until_stopped(out, e, stop)
+
+
+def _drain_shard(out, errors):
+    """Выдает записи шарда из очереди до маркера конца; ошибка шарда добавляется в errors."""
+    while True:
+        item = out.get()
+        if item is _SHARD_DONE:
+            return
+        if isinstance(item, Exception):
+            errors.append(str(item))
+            return
+        yield from item
+
+
+def iter_loki_entries_sharded(loki_url, start_ns, end_ns, filter_query, shards=None, max_workers=None, max_entries=None, gaps=None):
+    """
+    Читает логи из Loki, разбив окно на шарды по времени, которые запрашиваются параллельно.
+
+    Каждый шард читается постранично (iter_loki_entries) в свою ограниченную очередь
+    (не больше shard_prefetch_pages страниц впереди чтения). Шарды не пересекаются и идут
+    подряд, поэтому их записи выдаются по очереди — общий поток упорядочен по времени.
+    Когда потребитель прекращает чтение (лимит строк/байт), генератор закрывается и все шарды
+    перестают запрашивать страницы: объем загрузки определяется прочитанным, а не числом шардов.
+    Если часть шардов завершилась ошибкой, после выдачи полученных записей
+    выбрасывается RuntimeError.
+
+    :param shards: int, число шардов (по умолчанию CONFIG['loki']['shards'])
+    :param max_workers: int, одновременных запросов к Loki (по умолчанию CONFIG['loki']['shard_workers'])
+    :param max_entries: int, максимум записей с одного шарда (по умолчанию CONFIG['loki']['max_lines'])
+    :param gaps: list, описания пропущенных записей (см. iter_loki_entries)
+    :return: генератор пар (время в нс, строка лога)
+    """
+    loki_cfg = CONFIG.get('loki', {})
+    if shards is None:
+        shards = int(loki_cfg.get('shards', 4))
+    if max_workers is None:
+        max_workers = int(loki_cfg.get('shard_workers', 4))
+    if max_entries is None:
+        max_entries = int(loki_cfg.get('max_lines', 200000))
+    min_shard_ns = int(loki_cfg.get('min_shard_sec', 300)) * 1_000_000_000
+    prefetch_pages = max(1, int(loki_cfg.get('shard_prefetch_pages', 4)))
+
+    windows = split_time_window(start_ns, end_ns, shards, min_shard_ns)
+    if len(windows) == 1:
+        yield from iter_loki_entries(loki_url, start_ns, end_ns, filter_query, gaps=gaps)
+        return
+
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=prefetch_pages) for _ in windows]
+    errors = []
+    # Шарды отправляются в пул по порядку времени: шард, который читается сейчас, всегда уже запущен
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(windows))), thread_name_prefix="loki-shard")
+    try:
+        for (shard_start, shard_end), out in zip(windows, queues):
+            executor.submit(_fetch_shard_to_queue, loki_url, shard_start, shard_end, filter_query, max_entries, out, stop, gaps)
+        for out in queues:
+            yield from _drain_shard(out, errors)
+    finally:
+        # Досрочное закрытие (лимит достигнут) или конец: остальные шарды прекращают запросы
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if errors:
+        raise RuntimeError(f"не получено шардов: {len(errors)} из {len(windows)} ({errors[0]})")
+
+
+# Маскирование переменных частей строки лога для вычисления шаблона (порядок важен:
+# сначала длинные составные токены, затем отдельные числа)
+_LOG_MASKS = [
+    (re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'), '<TS>'),
+    (re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'), '<UUID>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'), '<IP>'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b|\b(?=[0-9a-fA-F]*\d)(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{8,}\b'), '<HEX>'),
+    (re.compile(r'\d+'), '<NUM>'),
+]
+
+
+def log_template(log):
+    """Шаблон строки лога: время, идентификаторы, адреса и числа заменены метками."""
+    for pattern, mask in _LOG_MASKS:
+        log = pattern.sub(mask, log)
+    return log
+
+
+class LogCondenser:
+    """
+    Сжатие логов: строки группируются по шаблону (log_template), для каждой группы
+    хранятся число строк, время первой и последней строки и пример. Дополнительно
+    сохраняются первые sample_lines строк без обработки.
+
+    Память ограничена max_clusters группами и sample_lines строками; строки новых
+    шаблонов сверх лимита учитываются в общей группе «прочее».
+    """
+
+    OTHER = '<прочие шаблоны>'
+
+    def __init__(self, max_clusters=500, sample_lines=200):
+        self.max_clusters = max_clusters
+        self.sample_lines = sample_lines
+        self.total = 0
+        self.sample = []
+        self._clusters = {}
+
+    def add(self, timestamp_ns, log):
+        self.total += 1
+        if len(self.sample) < self.sample_lines:
+            self.sample.append((timestamp_ns, log))
+        template = log_template(log)
+        cluster = self._clusters.get(template)
+        if cluster is None:
+            if len(self._clusters) >= self.max_clusters:
+                template = self.OTHER
+                cluster = self._clusters.get(template)
+            if cluster is None:
+                cluster = {"template": template, "count": 0, "first_ns": timestamp_ns, "last_ns": timestamp_ns, "example": log}
+                self._clusters[template] = cluster
+        cluster["count"] += 1
+        cluster["first_ns"] = min(cluster["first_ns"], timestamp_ns)
+        cluster["last_ns"] = max(cluster["last_ns"], timestamp_ns)
+
+    def clusters(self):
+        """Группы по убыванию числа строк: dict(template, count, first_ns, last_ns, example)."""
+        return sorted(self._clusters.values(), key=lambda c: c["count"], reverse=True)
+
+    def write(self, file):
+        """Записывает сводку по шаблонам и выборку исходных строк в текстовый файл."""
+        clusters = self.clusters()
+        file.write(f"# Сводка логов: {self.total} строк, {len(clusters)} шаблонов\n")
+        file.write("# строк | первая | последняя | шаблон\n")
+        for cluster in clusters:
+            first = datetime.fromtimestamp(cluster["first_ns"] / 1e9).strftime('%Y-%m-%d %H:%M:%S')
+            last = datetime.fromtimestamp(cluster["last_ns"] / 1e9).strftime('%Y-%m-%d %H:%M:%S')
+            file.write(f"{cluster['count']:>8} | {first} | {last} | {cluster['template']}\n")
+            file.write(f"{'':>8}   пример: {cluster['example']}\n")
+        file.write(f"\n# Первые {len(self.sample)} строк без обработки\n")
+        for timestamp, log in self.sample:
+            file.write(f"{datetime.fromtimestamp(timestamp / 1e9)} - {log}\n")
+
+
 # Функция для получения логов из Loki и их сохранения в файл
-def fetch_loki_logs(loki_url, start_timestamp, end_timestamp, filter_query, filename):
+def fetch_loki_logs(loki_url, start_timestamp, end_timestamp, filter_query, filename, max_lines=None, max_bytes=None, condense=None):
     """
     Получение логов из Loki и сохранение их в файл.
+
+    Окно делится на шарды по времени, которые читаются параллельно и постранично
+    (iter_loki_entries_sharded); шарды не пересекаются, поэтому их записи пишутся в файл
+    шард за шардом без слияния и сортировки, и память не зависит от числа строк. Выгрузка останавливается по бюджету
+    max_lines/max_bytes, о чем в конец файла добавляется пометка.
+    В режиме condense вместо всех строк в файл пишется сводка по шаблонам (LogCondenser).
+    При заданном CONFIG['loki']['compress']['format'] лог больше min_bytes сжимается
+    потоком (LogFileWriter), и возвращается путь к архиву .log.gz/.log.zst.
+
+    :param start_timestamp: int, начало диапазона в миллисекундах
+    :param end_timestamp: int, конец диапазона в миллисекундах
+    :param max_lines: int, максимум строк в файле (по умолчанию CONFIG['loki']['max_lines'])
+    :param max_bytes: int, максимум байт в файле (по умолчанию CONFIG['loki']['max_bytes'])
+    :param condense: bool, сжимать логи по шаблонам (по умолчанию CONFIG['loki']['condense']['enabled'])
+    :return: str, путь к файлу логов (или архиву) или None, если логи не получены
     """
-    # Конвертация меток времени в наносекунды
-    start_ns = int(str(start_timestamp)[:-3])
-    end_ns = int(str(end_timestamp)[:-3])
+    loki_cfg = CONFIG.get('loki', {})
+    condense_cfg = loki_cfg.get('condense', {})
+    if max_lines is None:
+        max_lines = int(loki_cfg.get('max_lines', 200000))
+    if max_bytes is None:
+        max_bytes = int(loki_cfg.get('max_bytes', 50 * 1024 * 1024))
+    if condense is None:
+        condense = bool(condense_cfg.get('enabled', False))
+    condenser = LogCondenser(
+        max_clusters=int(condense_cfg.get('max_clusters', 500)),
+        sample_lines=int(condense_cfg.get('sample_lines', 200)),
+    ) if condense else None
 
-    # Параметры запроса
-    params = {
-        'query': filter_query,
-        'start': start_ns,
-        'end': end_ns,
-        'limit': 1000
-    }
+    compress_cfg = loki_cfg.get('compress', {})
+    file_path = f'data_collectors/temporary_files/{filename}.log'
+    lines = 0
+    written = 0
+    truncated = None
+    # Наносекунды, записи которых не удалось прочитать целиком (см. iter_loki_entries)
+    gaps = []
 
-    # Отправка запроса на Loki
-    response = requests.get(loki_url, params=params)
-
-    # Обработка ответа от Loki
-    if response.status_code == 200:
-        log_data = response.json()
-        log_entries = []
-        for stream in log_data['data']['result']:
-            for entry in stream['values']:
-                timestamp, log = entry
-                log_entries.append(f"{datetime.fromtimestamp(int(timestamp) / 1e9)} - {log}")
-
-        # Сохранение логов в файл
-        file_path = f'data_collectors/temporary_files/{filename}.log'
-
-        with open(file_path, 'w', encoding='utf-8') as file:
-            for log_entry in log_entries:
-                file.write(log_entry + "\n")
-        print(f"Логи сохранены в {file_path}")
-        return file_path
+    try:
+        file = LogFileWriter(
+            file_path,
+            compress_format=compress_cfg.get('format'),
+            min_bytes=int(compress_cfg.get('min_bytes', 1024 * 1024)),
+        )
+    except OSError as e:
+        print(str(e))
+        return None
+
+    try:
+        try:
+            entries = iter_loki_entries_sharded(
+                loki_url, _to_ns(start_timestamp), _to_ns(end_timestamp), filter_query, max_entries=max_lines, gaps=gaps
+            )
+            try:
+                for timestamp, log in entries:
+                    log_entry = f"{datetime.fromtimestamp(timestamp / 1e9)} - {log}\n"
+                    size = len(log_entry.encode('utf-8'))
+                    if lines >= max_lines or written + size > max_bytes:
+                        truncated = f"... выгрузка остановлена: достигнут лимит ({max_lines} строк / {max_bytes} байт)"
+                        break
+                    if condenser is not None:
+                        condenser.add(timestamp, log)
+                    else:
+                        file.write(log_entry)
+                    lines += 1
+                    written += size
+            finally:
+                # Лимит достигнут — сразу останавливаем чтение шардов, не дожидаясь сборки мусора
+                entries.close()
+        except Exception as e:
+            if lines == 0:
+                raise
+            # Часть логов уже получена — сохраняем ее с пометкой об ошибке
+            truncated = f"... выгрузка прервана: {e}"
+        if condenser is not None:
+            condenser.write(file)
+        for gap in gaps:
+            file.write(f"... {gap}\n")
+        if truncated:
+            file.write(truncated + "\n")
+        file.close()
+    except Exception as e:
+        print(str(e))
+        file.discard()
+        return None
+    file_path = file.file_path
+
+    if condenser is not None:
+        print(f"Логи сохранены в {file_path} ({lines} строк, {len(condenser.clusters())} шаблонов)")
     else:
-        print(f"Ошибка при получении логов из Loki: {response.status_code} - {response.text}")
+        print(f"Логи сохранены в {file_path} ({lines} строк)")
+    return file_path
+
+
+_SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def _duration_seconds(duration):
+    """Длительность LogQL/PromQL ('30s', '5m', '1h') или число секунд -> секунды."""
+    text = str(duration).strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def sparkline(values, width=40):
+    """Строка-спарклайн из символов ▁..█; длинные ряды сворачиваются суммированием до width точек."""
+    values = list(values)
+    if not values:
+        return ""
+    if len(values) > width:
+        bucket = -(-len(values) // width)
+        values = [sum(values[i:i + bucket]) for i in range(0, len(values), bucket)]
+    peak = max(values)
+    if peak <= 0:
+        return _SPARK_CHARS[0] * len(values)
+    return "".join(_SPARK_CHARS[min(len(_SPARK_CHARS) - 1, int(v / peak * (len(_SPARK_CHARS) - 1)))] for v in values)
+
+
+def fetch_loki_log_metrics(loki_url, start_timestamp, end_timestamp, filter_query, step=None, group_by=None):
+    """
+    Агрегирует логи на стороне Loki метрическим запросом вместо выгрузки строк:
+    sum by (<group_by>) (count_over_time(<filter_query> [step])).
+
+    :param loki_url: str, endpoint Loki .../loki/api/v1/query_range
+    :param start_timestamp: int, начало диапазона в миллисекундах
+    :param end_timestamp: int, конец диапазона в миллисекундах
+    :param filter_query: str, LogQL-запрос выборки строк (как в записи logs metrics_config.py)
+    :param step: str, шаг агрегации (по умолчанию CONFIG['loki']['metrics']['step'])
+    :param group_by: str, метка группировки (по умолчанию CONFIG['loki']['metrics']['group_by'])
+    :return: dict(query, step, series=[{"labels": dict, "values": [(время в с, число строк), ...]}])
+             или None при ошибке
+    """
+    metrics_cfg = CONFIG.get('loki', {}).get('metrics', {})
+    step = step or metrics_cfg.get('step', '60s')
+    group_by = group_by or metrics_cfg.get('group_by', 'level')
+    query = f'sum by ({group_by}) (count_over_time({filter_query} [{step}]))'
+    params = {
+        'query': query,
+        'start': _to_ns(start_timestamp),
+        'end': _to_ns(end_timestamp),
+        'step': step
+    }
+    try:
+        response = http_client.get(loki_url, params=params)
+        if response.status_code != 200:
+            print(f"Ошибка метрического запроса к Loki: {response.status_code} - {response.text}")
+            return None
+        series = [
+            {
+                "labels": item.get("metric", {}),
+                "values": [(float(ts), float(value)) for ts, value in item.get("values", [])]
+            }
+            for item in response.json()['data']['result']
+        ]
+    except Exception as e:
+        print(f"Ошибка метрического запроса к Loki: {str(e)}")
         return None
+    return {"query": query, "step": step, "series": series}
+
+
+def loki_log_metrics_table(log_metrics):
+    """
+    Разметка Confluence для результата fetch_loki_log_metrics: таблица по группам
+    (всего строк, пик за шаг и его время, динамика спарклайном).
+    """
+    # Группы без точек пропускаются: для них нет ни пика, ни границ сетки
+    series = [s for s in (log_metrics or {}).get("series") or [] if s.get("values")]
+    if not series:
+        return "<p>Нет записей логов за период теста.</p>"
+
+    step_sec = _duration_seconds(log_metrics.get("step", "60s"))
+    # Общая сетка времени для всех групп: Loki не возвращает точки с нулем строк
+    first = min(ts for s in series for ts, _ in s["values"])
+    last = max(ts for s in series for ts, _ in s["values"])
+    grid = [first + i * step_sec for i in range(int((last - first) // step_sec) + 1)]
+
+    rows = []
+    for s in sorted(series, key=lambda s: sum(v for _, v in s["values"]), reverse=True):
+        by_ts = dict(s["values"])
+        values = [by_ts.get(ts, 0.0) for ts in grid]
+        peak_ts, peak = max(s["values"], key=lambda point: point[1])
+        name = ", ".join(f"{k}={v}" for k, v in sorted(s["labels"].items())) or "все"
+        rows.append(
+            f"<tr><td>{html.escape(name)}</td><td>{int(sum(values))}</td><td>{int(peak)}</td>"
+            f"<td>{datetime.fromtimestamp(peak_ts).strftime('%Y-%m-%d %H:%M:%S')}</td>"
+            f"<td><code>{sparkline(values)}</code></td></tr>"
+        )
+    return (
+        "<table><tbody>"
+        f"<tr><th>Группа</th><th>Всего строк</th><th>Пик за {html.escape(str(log_metrics.get('step')))}</th>"
+        "<th>Время пика</th><th>Динамика</th></tr>"
+        + "".join(rows)
+        + "</tbody></table>"
+    )
 
 
 # Основная функция для загрузки логов на Confluence
-def uploadFromLoki(loki_url, start_timestamp, end_timestamp, filter_query, user, password, url_basic, page_id, service, microservice):
+def uploadFromLoki(loki_url, start_timestamp, end_timestamp, filter_query, user, password, url_basic, page_id, service, microservice, gateway=None):
     """
     Загрузка логов из Loki и отправка их в виде вложения на Confluence.
+    gateway — общее подключение к Confluence (по умолчанию — общее для user/password).
     """
     try:
         # Получение логов из Loki и сохранение в файл
@@ -99,12 +693,13 @@ def uploadFromLoki(loki_url, start_timestamp, end_timestamp, filter_query, user,
 
         # Отправка файла на Confluence
         auth = HTTPBasicAuth(user, password)
-        response = send_loki_file_to_attachment(url_basic, auth, page_id, file_path)
+        gateway = gateway or get_confluence_gateway(url_basic, user, password)
+        response = send_loki_file_to_attachment(url_basic, auth, page_id, file_path, gateway=gateway)
 
         if response:
             print("Вложение отправлено на страницу Confluence.")
             # Формирование разметки для отображения вложения
-            utils = f'<ac:structured-macro ac:name="view-file" ac:schema-version="1"><ac:parameter ac:name="name"><ri:attachment ri:filename="{filename}.log" /></ac:parameter><ac:parameter ac:name="height">250</ac:parameter></ac:structured-macro>'
+            utils = loki_attachment_macro(file_path)
         else:
             utils = ""
         
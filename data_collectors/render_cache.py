@@ -0,0 +1,184 @@
+# render_cache.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from urllib.parse import urlparse, parse_qsl
+
+from config import CONFIG  # Базовые настройки
+
+
+# Параметры запроса рендера, которые входят в ключ отдельно от остальных
+_WINDOW_PARAMS = ("from", "to")
+_SIZE_PARAMS = ("width", "height")
+
+
+def _parse_epoch_ms(value):
+    """Возвращает метку времени в мс или None для относительных значений вида now-1h."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def render_cache_key(image_url):
+    """
+    Формирует ключ кэша рендера по URL панели.
+
+    Ключ — sha256 от нормализованного URL панели (путь и параметры без учета порядка),
+    окна from/to, размеров width/height и переменных var-*.
+
+    :param image_url: str, полный URL рендера панели Grafana
+    :return: str, hex-строка ключа
+    """
+    parsed = urlparse(image_url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    window = {k: v for k, v in params if k in _WINDOW_PARAMS}
+    size = {k: v for k, v in params if k in _SIZE_PARAMS}
+    variables = sorted((k, v) for k, v in params if k.startswith("var-"))
+    other = sorted(
+        (k, v) for k, v in params
+        if k not in _WINDOW_PARAMS and k not in _SIZE_PARAMS and not k.startswith("var-")
+    )
+    payload = {
+        "panel": f"{parsed.netloc.lower()}{parsed.path}",
+        "params": other,
+        "from": window.get("from"),
+        "to": window.get("to"),
+        "width": size.get("width"),
+        "height": size.get("height"),
+        "vars": variables,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_closed_window(image_url, min_age_sec=60):
+    """
+    Проверяет, что окно рендера закрыто: from/to заданы абсолютными метками
+    и to отстоит от текущего момента не менее чем на min_age_sec.
+    Только такие рендеры не меняются и могут браться из кэша.
+    """
+    params = dict(parse_qsl(urlparse(image_url).query, keep_blank_values=True))
+    start = _parse_epoch_ms(params.get("from"))
+    end = _parse_epoch_ms(params.get("to"))
+    if start is None or end is None:
+        return False
+    return end <= (time.time() - min_age_sec) * 1000
+
+
+class RenderCache:
+    """
+    Дисковый кэш изображений панелей Grafana с адресацией по содержимому запроса.
+
+    Файлы хранятся в каталоге cache_dir под именем ключа; время последнего обращения
+    отражается в mtime файла. При превышении max_bytes удаляются файлы
+    с самым старым mtime (LRU).
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.img")
+
+    def _entries(self):
+        """Список (путь, размер, mtime) файлов кэша."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".img"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key):
+        """
+        Возвращает открытый файл с изображением или None, если ключа нет в кэше.
+
+        :param key: str, ключ из render_cache_key
+        :return: file-like объект (вызывающий код закрывает его) или None
+        """
+        path = self._path(key)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        # Отмечаем обращение для LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return file
+
+    def put(self, key, fileobj):
+        """
+        Сохраняет содержимое fileobj в кэш и возвращает fileobj на начало.
+
+        :param key: str, ключ из render_cache_key
+        :param fileobj: file-like объект с изображением
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        try:
+            with open(tmp_path, "wb") as tmp:
+                for chunk in iter(lambda: fileobj.read(64 * 1024), b""):
+                    tmp.write(chunk)
+                    size += len(chunk)
+            with self._lock:
+                replaced = os.path.getsize(path) if os.path.exists(path) else 0
+                # Атомарная замена: параллельные читатели видят либо старый, либо новый файл целиком
+                os.replace(tmp_path, path)
+                self._total_bytes += size - replaced
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            print(f"Не удалось сохранить рендер в кэш: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            fileobj.seek(0)
+
+    def _evict(self):
+        # Вызывается под self._lock: удаляем самые давно использованные файлы до max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                total -= size
+        self._total_bytes = total
+
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    """Возвращает общий для процесса RenderCache или None, если кэш выключен в CONFIG['render_cache']."""
+    global _render_cache
+    cache_cfg = CONFIG.get('render_cache', {}) or {}
+    if not cache_cfg.get('enabled', False):
+        return None
+    with _render_cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache(
+                cache_dir=cache_cfg.get('dir', 'data_collectors/render_cache'),
+                max_bytes=cache_cfg.get('max_bytes', 512 * 1024 * 1024),
+            )
+        return _render_cache
@@ -0,0 +1,127 @@
+# report_jobs.py
+
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config import CONFIG  # Базовые настройки
+from update_page import update_report
+
+
+# Стадии отчета в порядке выполнения
+JOB_STAGES = ("copy_page", "panels", "logs", "llm", "commit")
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class ReportJobManager:
+    """
+    Очередь асинхронных задач на создание отчета.
+
+    Задачи выполняются в ограниченном пуле потоков, состояние и прогресс по стадиям
+    хранятся в памяти процесса и доступны по идентификатору задачи.
+    """
+
+    def __init__(self, max_workers=2, keep_finished=100):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._keep_finished = keep_finished
+
+    def submit(self, start, end, service, use_render_cache=True):
+        """Ставит отчет в очередь и возвращает идентификатор задачи."""
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "service": service,
+            "start": start,
+            "end": end,
+            "use_render_cache": use_render_cache,
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "page_id": None,
+            "timings": None,
+            "error": None,
+            "stages": {stage: {"status": "pending"} for stage in JOB_STAGES},
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._evict_finished()
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id):
+        """Возвращает копию состояния задачи или None, если задача не найдена."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job else None
+
+    def list(self):
+        """Возвращает состояния всех задач, новые первыми."""
+        with self._lock:
+            jobs = [self._snapshot(job) for job in self._jobs.values()]
+        return sorted(jobs, key=lambda j: j["created_at"], reverse=True)
+
+    def _run(self, job_id):
+        self._update(job_id, status="running", started_at=_now())
+
+        def progress(stage, status=None, done=None, total=None):
+            self._update_stage(job_id, stage, status=status, done=done, total=total)
+
+        with self._lock:
+            job = self._jobs[job_id]
+            start, end, service = job["start"], job["end"], job["service"]
+            use_render_cache = job["use_render_cache"]
+        try:
+            summary = update_report(start, end, service, progress=progress,
+                                    use_render_cache=use_render_cache) or {}
+            self._update(job_id, status="success", finished_at=_now(),
+                         page_id=summary.get("page_id"), timings=summary.get("timings"))
+        except Exception as e:
+            traceback.print_exc()
+            self._update(job_id, status="error", finished_at=_now(), error=str(e))
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.update(fields)
+
+    def _update_stage(self, job_id, stage, status=None, done=None, total=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job:
+                return
+            state = job["stages"].setdefault(stage, {"status": "pending"})
+            if status is not None:
+                state["status"] = status
+            if done is not None:
+                state["done"] = done
+            if total is not None:
+                state["total"] = total
+
+    def _evict_finished(self):
+        # Вызывается под self._lock: удаляем самые старые завершенные задачи сверх лимита
+        finished = [j for j in self._jobs.values() if j["status"] in ("success", "error")]
+        excess = len(finished) - self._keep_finished
+        if excess > 0:
+            for job in sorted(finished, key=lambda j: j["created_at"])[:excess]:
+                self._jobs.pop(job["id"], None)
+
+    @staticmethod
+    def _snapshot(job):
+        snapshot = dict(job)
+        snapshot["stages"] = {stage: dict(state) for stage, state in job["stages"].items()}
+        return snapshot
+
+
+report_jobs = ReportJobManager(
+    max_workers=int(CONFIG.get('report_workers', 2)),
+    keep_finished=int(CONFIG.get('report_jobs_keep', 100)),
+)
@@ -1,18 +1,202 @@
-from confluence_manager.update_confluence_template import copy_confluence_page, update_confluence_page, update_confluence_page_multi, render_llm_report_placeholders, render_llm_markdown
+from confluence_manager.update_confluence_template import copy_confluence_page, update_confluence_page_multi, render_llm_report_placeholders, render_llm_markdown
+from confluence_manager.confluence_gateway import get_confluence_gateway
 from AI.main import uploadFromLLM
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from data_collectors.grafana_collector import uploadFromGrafana
-from data_collectors.loki_collector import uploadFromLoki
+from data_collectors.grafana_collector import GrafanaRenderer, grafana_image_macro
+from data_collectors.loki_collector import fetch_loki_logs, loki_attachment_macro, log_attachment_content_type, fetch_loki_log_metrics, loki_log_metrics_table
 from config import CONFIG  # Импорт базовой конфигурации
 from metrics_config import METRICS_CONFIG  # Импорт конфигурации метрик
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 import time
 from datetime import datetime  # если ещё не импортирован
 import traceback  # для детального вывода ошибок (опционально)
 
 
-def update_report(start, end, service):
+def _timed(func, *args, **kwargs):
+    """Выполняет func и возвращает пару (результат, длительность в секундах)."""
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def _print_timings(stage_timings, task_timings, render_stats=None):
+    """Печатает сводку по длительности стадий, самым медленным задачам сбора
+    и ожиданию/рендеру панелей Grafana."""
+    print("Длительность стадий отчета:")
+    for stage, elapsed in stage_timings.items():
+        print(f"  {stage}: {elapsed:.2f} с")
+    slowest = sorted(task_timings, key=lambda t: t[2], reverse=True)[:5]
+    if slowest:
+        print("Самые медленные задачи сбора:")
+        for kind, name, elapsed in slowest:
+            print(f"  [{kind}] {name}: {elapsed:.2f} с")
+    if render_stats:
+        print("Рендер панелей Grafana (ожидание слота / рендер):")
+        for name, stats in sorted(render_stats, key=lambda r: r[1]["queue_wait"] + r[1]["render_time"], reverse=True):
+            source = "кэш" if stats["cached"] else f"попыток {stats['attempts']}, статус {stats['status']}"
+            print(f"  {name}: {stats['queue_wait']:.2f} с / {stats['render_time']:.2f} с ({source})")
+
+
+def _build_llm_replacements(results):
+    """Формирует словарь {плейсхолдер: markdown} из результатов uploadFromLLM.
+    Подставляются только те плейсхолдеры, для которых есть данные.
+    """
+    llm_replacements = {}
+
+    def add_if_present(placeholder: str, key: str):
+        val = results.get(key)
+        if isinstance(val, str) and val.strip():
+            llm_replacements[placeholder] = val
+
+    add_if_present("$$answer_jvm$$", "jvm")
+    add_if_present("$$answer_database$$", "database")
+    add_if_present("$$answer_kafka$$", "kafka")
+    add_if_present("$$answer_ms$$", "ms")
+
+    # Добавляем структурированные плейсхолдеры, если есть JSON
+    final_struct = results.get("final_parsed")
+    if isinstance(final_struct, dict) and final_struct:
+        md = render_llm_markdown(final_struct)
+        if md.strip():
+            llm_replacements["$$answer_llm$$"] = md
+            llm_replacements["$$final_answer$$"] = md
+    else:
+        # Фолбэк: если нет структурированного ответа, отдаем текст как markdown-блок
+        final_text = results.get("final")
+        if isinstance(final_text, str) and final_text.strip():
+            md_fallback = f"### Итог LLM\n\n{final_text}"
+            llm_replacements["$$final_answer$$"] = md_fallback
+            llm_replacements["$$answer_llm$$"] = md_fallback
+
+    # Доменные секции в человекочитаемом markdown при наличии parsed
+    for placeholder, key in (
+        ("$$answer_jvm$$", "jvm_parsed"),
+        ("$$answer_database$$", "database_parsed"),
+        ("$$answer_kafka$$", "kafka_parsed"),
+        ("$$answer_ms$$", "ms_parsed"),
+    ):
+        struct = results.get(key)
+        if isinstance(struct, dict) and struct:
+            md = render_llm_markdown(struct)
+            if md.strip():
+                llm_replacements[placeholder] = md
+
+    return llm_replacements
+
+
+def _commit_with_retry(url, username, password, page_id, replacements, max_attempts=3, gateway=None):
+    """Применяет все замены одним вызовом update_confluence_page_multi с повторами при ошибках/конфликте версий."""
+    for attempt in range(max_attempts):
+        try:
+            res = update_confluence_page_multi(url, username, password, page_id, replacements, gateway=gateway)
+            # Обработка текстовых ошибок из update_confluence_page_multi
+            if isinstance(res, str) and res.startswith("Ошибка"):
+                raise RuntimeError(res)
+            return res
+        except Exception as e:
+            if ("Attempted to update stale data" in str(e) or "conflict" in str(e).lower()) and attempt < max_attempts-1:
+                print(f"Попытка {attempt+1} не удалась, повторяем через 1 секунду...")
+                time.sleep(1)
+            elif attempt < max_attempts-1:
+                print(f"Попытка {attempt+1} не удалась: {e}. Повтор через 1 секунду...")
+                time.sleep(1)
+            else:
+                raise e
+
+
+def _collect_grafana_panel(name, grafana_url, attachment_name, renderer, render_stats, use_render_cache=True):
+    """Рендерит панель в буфер (или берет из кэша рендеров); возвращает элемент для пакетной загрузки или None.
+    Время ожидания слота рендерера и время рендера добавляются в render_stats."""
+    buffer, stats = renderer.render(grafana_url, use_cache=use_render_cache)
+    render_stats.append((name, stats))
+    if buffer is None:
+        return None
+    return {
+        "attachment": attachment_name,
+        "file": buffer,
+        "macro": grafana_image_macro(attachment_name),
+        "cleanup": buffer.close,
+    }
+
+
+def _collect_loki_log(loki_url, start, end, filter_query, filename, condense=None):
+    """Выгружает логи в файл (или сводку по шаблонам при condense); возвращает элемент для пакетной загрузки или None."""
+    file_path = fetch_loki_logs(loki_url, start, end, filter_query, filename, condense=condense)
+    if file_path is None:
+        return None
+    log_file = open(file_path, 'rb')
+
+    def cleanup():
+        log_file.close()
+        os.remove(file_path)
+
+    attachment_name = os.path.basename(file_path)
+    return {
+        "attachment": attachment_name,
+        "file": log_file,
+        "content_type": log_attachment_content_type(file_path),
+        "macro": loki_attachment_macro(file_path),
+        "cleanup": cleanup,
+    }
+
+
+def _resolve_log_metrics(log_metrics_futures):
+    """Дожидается метрических запросов Loki и возвращает ряды для контекста LLM: [{label, query, step, series}].
+    Запросы с ошибкой или без данных пропускаются."""
+    log_metrics = []
+    for placeholder, future in log_metrics_futures.items():
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Ошибка метрического запроса логов {placeholder}: {e}")
+            continue
+        if result and result.get("series"):
+            log_metrics.append({"label": placeholder, **result})
+    return log_metrics
+
+
+def _upload_batch(gateway, page_id, items):
+    """Загружает пакет вложений одним запросом и возвращает {плейсхолдер: разметка} для загруженных."""
+    try:
+        files = [
+            (item["attachment"], item["file"], item["content_type"]) if item.get("content_type")
+            else (item["attachment"], item["file"])
+            for item in items
+        ]
+        uploaded = gateway.upload_attachments(page_id, files)
+    finally:
+        for item in items:
+            try:
+                item["cleanup"]()
+            except Exception as e:
+                print(f"Ошибка при освобождении {item['attachment']}: {e}")
+    snippets = {}
+    for item in items:
+        if item["attachment"] in uploaded:
+            snippets[item["placeholder"]] = item["macro"]
+        else:
+            print(f"Вложение {item['attachment']} не загружено")
+    return snippets
+
+
+def _noop_progress(stage, status=None, done=None, total=None):
+    pass
+
+
+def update_report(start, end, service, progress=None, use_render_cache=True):
+    """
+    Создает отчет: копирует шаблон страницы, собирает графики/логи и анализ LLM,
+    затем обновляет все плейсхолдеры одним коммитом.
+
+    :param progress: callable(stage, status=None, done=None, total=None) для отчета о прогрессе
+                     по стадиям copy_page, panels, logs, llm, commit (опционально)
+    :param use_render_cache: bool, брать рендеры панелей закрытого окна из кэша (False — рендерить заново)
+    :return: dict с идентификатором созданной страницы и длительностями стадий;
+             если страницу не удалось обновить (ошибка коммита или ни одной замены), исключение пробрасывается
+    """
+    progress = progress or _noop_progress
+
     # Получение параметров из `config.py`
     user = CONFIG['user']
     password = CONFIG['password']
@@ -32,130 +216,194 @@ def update_report(start, end, service):
     # Получаем `page_sample_id` и `page_parent_id` из конфигурации сервиса
     page_parent_id = service_config["page_parent_id"]
     page_sample_id = service_config["page_sample_id"]
-    copy_page_id = copy_confluence_page(url_basic, user, password, page_sample_id, page_parent_id)
-   
 
-    # Список задач для обновлений
-    tasks = []
-    
-                
-    # Добавим функцию обновления с повторными попытками
-    def update_with_retry(url, username, password, page_id, data_to_find, replace_text, max_attempts=3):
-        for attempt in range(max_attempts):
-            try:
-                res = update_confluence_page(url, username, password, page_id, data_to_find, replace_text)
-                # Обработка текстовых ошибок из update_confluence_page
-                if isinstance(res, str) and (res.startswith("Ошибка") or res == "Плейсхолдер не найден"):
-                    raise RuntimeError(res)
-                return res
-            except Exception as e:
-                if ("Attempted to update stale data" in str(e) or "conflict" in str(e).lower()) and attempt < max_attempts-1:
-                    print(f"Попытка {attempt+1} не удалась, повторяем через 1 секунду...")
-                    time.sleep(1)
-                elif attempt < max_attempts-1:
-                    print(f"Попытка {attempt+1} не удалась: {e}. Повтор через 1 секунду...")
-                    time.sleep(1)
-                else:
-                    raise e
+    # Длительности стадий отчета (секунды) и отдельных задач сбора
+    stage_timings = {}
+    task_timings = []
+    render_stats = []
+
+    # Одно подключение к Confluence (сессия и пул соединений) на весь отчет
+    gateway = get_confluence_gateway(url_basic, user, password)
+
+    # Записи логов с "mode": "metrics" агрегируются на стороне Loki (count_over_time).
+    # Запросы выполняются параллельно со всем отчетом: поток LLM ждет их только при сборке
+    # контекста, а таблицы на странице заполняются перед коммитом.
+    all_logs = service_config.get("logs", [])
+    metric_logs = [log for log in all_logs if log.get("mode") == "metrics"]
+    log_metrics_executor = ThreadPoolExecutor(
+        max_workers=max(1, min(len(metric_logs), int(CONFIG.get('loki', {}).get('metrics', {}).get('workers', 4)))),
+        thread_name_prefix="loki-metrics"
+    )
+    log_metrics_futures = {
+        log["placeholder"]: log_metrics_executor.submit(
+            fetch_loki_log_metrics, loki_url, start, end, log["filter_query"], log.get("step"), log.get("group_by")
+        )
+        for log in metric_logs
+    }
+    log_metrics_executor.shutdown(wait=False)
 
-    # Основной код с разделением параллельных и последовательных операций
-    metrics_logs_tasks = []
+    progress("copy_page", status="running")
+    copy_page_id, stage_timings["copy_page"] = _timed(
+        copy_confluence_page, url_basic, user, password, page_sample_id, page_parent_id, gateway=gateway
+    )
+    if not copy_page_id:
+        progress("copy_page", status="error")
+        raise RuntimeError("Не удалось создать копию шаблона страницы Confluence")
+    progress("copy_page", status="done")
+
+    metrics = service_config["metrics"]
+    logs = [log for log in all_logs if log.get("mode") != "metrics"]
+
+    replacements = {}
+    progress("panels", status="running", done=0, total=len(metrics))
+    progress("logs", status="running", done=0, total=len(logs))
+
+    # Стадия LLM (Prometheus + анализ) не зависит от графиков и логов, поэтому
+    # запускается сразу в отдельном потоке и выполняется параллельно со сбором.
+    llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+    progress("llm", status="running")
+    llm_future = llm_executor.submit(
+        _timed, uploadFromLLM, start/1000, end/1000,
+        progress_callback=lambda done, total: progress("llm", done=done, total=total),
+        # Метрики логов ждет сам поток LLM и только тогда, когда строит контекст
+        log_metrics=lambda: _resolve_log_metrics(log_metrics_futures),
+    )
+
+    # Стадия сбора: рендер панелей Grafana и выгрузка логов Loki выполняются в ограниченном
+    # пуле потоков. Готовые изображения/логи загружаются во вложения пакетами по
+    # attachment_batch_size файлов (один multipart-запрос на пакет) в том же пуле,
+    # не дожидаясь окончания сбора. Фрагменты разметки накапливаются в памяти и
+    # попадают на страницу одним коммитом в конце.
+    collect_workers = int(CONFIG.get('collect_workers', 8))
+    batch_size = max(1, int(CONFIG.get('attachment_batch_size', 10)))
+    collect_started = time.perf_counter()
+    collect_tasks = {}
+    upload_tasks = {}
+    pending_items = []
+
+    # Рендерер Grafana сам ограничивает число одновременных рендеров на хост:
+    # лишние потоки пула ждут слот, а не перегружают image renderer
+    renderer = GrafanaRenderer(grafana_login, grafana_pass)
+
+    with ThreadPoolExecutor(max_workers=collect_workers, thread_name_prefix="collect") as executor:
+        def submit_upload(items):
+            batch_no = len(upload_tasks) + 1
+            future = executor.submit(_timed, _upload_batch, gateway, copy_page_id, items)
+            upload_tasks[future] = f"batch {batch_no} ({len(items)} файлов)"
 
-    with ThreadPoolExecutor() as executor:
         # Добавляем задачи для каждой метрики, указанной для выбранного сервиса
-        for metric in service_config["metrics"]:
+        for metric in metrics:
             # Формируем полный URL для метрики с учетом базового URL Grafana и временного диапазона
             grafana_url = f"{grafana_base_url}{metric['grafana_url']}&from={start}&to={end}"
             name = metric['name']
 
-            # Добавляем задачу для загрузки метрики и обновления Confluence
-            metrics_logs_tasks.append(executor.submit(
-                update_confluence_page,
-                url_basic, user, password, copy_page_id,
-                f"$${name}$$",
-                uploadFromGrafana(user, password, url_basic, space_conf, copy_page_id, [[name, grafana_url]], service, grafana_login, grafana_pass)
-            ))
+            future = executor.submit(
+                _timed, _collect_grafana_panel,
+                name, grafana_url, f"{name}_{service}_{copy_page_id}.jpg", renderer, render_stats,
+                use_render_cache
+            )
+            collect_tasks[future] = ("grafana", name, f"$${name}$$")
 
         # Добавление задач для логов, если они есть в конфигурации сервиса
-        for log in service_config.get("logs", []):
+        for log in logs:
             placeholder = log["placeholder"]
             filter_query = log["filter_query"]
 
-            metrics_logs_tasks.append(executor.submit(
-                update_confluence_page,
-                url_basic, user, password, copy_page_id,
-                f"$${placeholder}$$",
-                uploadFromLoki(loki_url, start, end, filter_query, user, password, url_basic, copy_page_id, service, placeholder)
-            ))
-        
+            future = executor.submit(
+                _timed, _collect_loki_log,
+                loki_url, start, end, filter_query, f"{service}_{placeholder}_{copy_page_id}",
+                log.get("condense")
+            )
+            collect_tasks[future] = ("loki", placeholder, f"$${placeholder}$$")
+
         # Обработка результатов метрик и логов
-        for future in as_completed(metrics_logs_tasks):
+        done_by_kind = {"grafana": 0, "loki": 0}
+        for future in as_completed(collect_tasks):
+            kind, name, data_to_find = collect_tasks[future]
             try:
-                result = future.result()
-                print(f"Метрика/лог обновлены: {result}")
+                item, elapsed = future.result()
+                task_timings.append((kind, name, elapsed))
+                if item is not None:
+                    item["placeholder"] = data_to_find
+                    pending_items.append(item)
+                    print(f"Метрика/лог собраны ({name}, {elapsed:.2f} с)")
+                else:
+                    print(f"Метрика/лог не получены ({name})")
             except Exception as e:
-                print(f"Ошибка при обновлении метрики/лога: {e}")
+                print(f"Ошибка при сборе метрики/лога {name}: {e}")
+            done_by_kind[kind] += 1
+            progress("panels" if kind == "grafana" else "logs", done=done_by_kind[kind])
 
-    # Получаем результаты LLM и обновляем их последовательно
-    results = uploadFromLLM(start/1000, end/1000)
+            if len(pending_items) >= batch_size:
+                submit_upload(pending_items)
+                pending_items = []
 
-    # Мульти-обновление плейсхолдеров LLM за один проход
-    try:
-        print("Обновление данных LLM (одним проходом)...")
-        llm_replacements = {}
-        # Подставляем только те плейсхолдеры, для которых есть данные
-        def add_if_present(placeholder: str, key: str):
-            val = results.get(key)
-            if isinstance(val, str) and val.strip():
-                llm_replacements[placeholder] = val
-
-        add_if_present("$$answer_jvm$$", "jvm")
-        add_if_present("$$answer_database$$", "database")
-        add_if_present("$$answer_kafka$$", "kafka")
-        add_if_present("$$answer_ms$$", "ms")
-
-        # Добавляем структурированные плейсхолдеры, если есть JSON
-        final_struct = results.get("final_parsed")
-        if isinstance(final_struct, dict) and final_struct:
-            md = render_llm_markdown(final_struct)
-            if md.strip():
-                llm_replacements["$$answer_llm$$"] = md
-                llm_replacements["$$final_answer$$"] = md
-        else:
-            # Фолбэк: если нет структурированного ответа, отдаем текст как markdown-блок
-            final_text = results.get("final")
-            if isinstance(final_text, str) and final_text.strip():
-                md_fallback = f"### Итог LLM\n\n{final_text}"
-                llm_replacements["$$final_answer$$"] = md_fallback
-                llm_replacements["$$answer_llm$$"] = md_fallback
-
-        # Доменные секции в человекочитаемом markdown при наличии parsed
-        jvm_struct = results.get("jvm_parsed")
-        if isinstance(jvm_struct, dict) and jvm_struct:
-            md = render_llm_markdown(jvm_struct)
-            if md.strip():
-                llm_replacements["$$answer_jvm$$"] = md
+        if pending_items:
+            submit_upload(pending_items)
+            pending_items = []
 
-        db_struct = results.get("database_parsed")
-        if isinstance(db_struct, dict) and db_struct:
-            md = render_llm_markdown(db_struct)
-            if md.strip():
-                llm_replacements["$$answer_database$$"] = md
+        # Сопоставление загруженных вложений с плейсхолдерами
+        for future in as_completed(upload_tasks):
+            label = upload_tasks[future]
+            try:
+                snippets, elapsed = future.result()
+                task_timings.append(("upload", label, elapsed))
+                replacements.update(snippets)
+            except Exception as e:
+                print(f"Ошибка при загрузке вложений ({label}): {e}")
 
-        kafka_struct = results.get("kafka_parsed")
-        if isinstance(kafka_struct, dict) and kafka_struct:
-            md = render_llm_markdown(kafka_struct)
-            if md.strip():
-                llm_replacements["$$answer_kafka$$"] = md
+    progress("panels", status="done")
+    progress("logs", status="done")
 
-        ms_struct = results.get("ms_parsed")
-        if isinstance(ms_struct, dict) and ms_struct:
-            md = render_llm_markdown(ms_struct)
-            if md.strip():
-                llm_replacements["$$answer_ms$$"] = md
+    stage_timings["collect"] = time.perf_counter() - collect_started
+    for kind in ("grafana", "loki", "upload"):
+        durations = [elapsed for (k, _, elapsed) in task_timings if k == kind]
+        if durations:
+            stage_timings[f"{kind}_slowest_task"] = max(durations)
+            stage_timings[f"{kind}_tasks_total"] = sum(durations)
+    if render_stats:
+        stage_timings["grafana_queue_wait_total"] = sum(s["queue_wait"] for _, s in render_stats)
+        stage_timings["grafana_render_total"] = sum(s["render_time"] for _, s in render_stats)
+
+    # Таблицы по метрикам логов (запросы к этому моменту обычно уже завершены)
+    for placeholder, future in log_metrics_futures.items():
+        try:
+            replacements[f"$${placeholder}$$"] = loki_log_metrics_table(future.result())
+        except Exception as e:
+            print(f"Ошибка при построении таблицы метрик логов {placeholder}: {e}")
 
-        update_confluence_page_multi(url_basic, user, password, copy_page_id, llm_replacements)
-        print("✓ Плейсхолдеры LLM обновлены за один проход")
+    # Точка соединения: дожидаемся стадии LLM перед коммитом страницы
+    llm_wait_started = time.perf_counter()
+    try:
+        results, stage_timings["llm"] = llm_future.result()
+        replacements.update(_build_llm_replacements(results))
+        progress("llm", status="done")
     except Exception as e:
-        print(f"Ошибка при мульти-обновлении данных LLM: {e}")
+        print(f"Ошибка при получении/подготовке данных LLM: {e}")
+        progress("llm", status="error")
+    finally:
+        llm_executor.shutdown(wait=False)
+    # Сколько LLM-стадия добавила сверх сбора графиков/логов
+    stage_timings["llm_wait_after_collect"] = time.perf_counter() - llm_wait_started
+
+    progress("commit", status="running")
+    try:
+        print(f"Обновление страницы одним проходом ({len(replacements)} плейсхолдеров)...")
+        result, stage_timings["commit"] = _timed(
+            _commit_with_retry, url_basic, user, password, copy_page_id, replacements, gateway=gateway
+        )
+        if result == "Нет замен":
+            # Ни один плейсхолдер не найден — страница осталась незаполненной копией шаблона
+            raise RuntimeError(f"На странице {copy_page_id} не найдено ни одного плейсхолдера для замены")
+        print(f"✓ Плейсхолдеры обновлены за один проход: {result}")
+        progress("commit", status="done")
+    except Exception as e:
+        print(f"Ошибка при мульти-обновлении страницы: {e}")
+        progress("commit", status="error")
+        _print_timings(stage_timings, task_timings, render_stats)
+        # Ошибка коммита — ошибка всего отчета: задача в report_jobs получает статус error
+        raise
+
+    _print_timings(stage_timings, task_timings, render_stats)
+    return {"page_id": copy_page_id, "timings": stage_timings}
 
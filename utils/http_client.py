@@ -0,0 +1,118 @@
+# http_client.py
+
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import CONFIG  # Базовые настройки
+
+
+# Значения по умолчанию; переопределяются секцией CONFIG['http'] и CONFIG['http']['hosts'][<host>]
+_DEFAULTS = {
+    'pool_connections': 4,  # число пулов соединений на сессию
+    'pool_maxsize': 32,  # keep-alive соединений на хост (не меньше числа потоков сбора)
+    'retries': 3,  # повторы при ошибках соединения и статусах из status_forcelist
+    'backoff_factor': 0.5,  # пауза между повторами: backoff_factor * 2 ** (попытка - 1)
+    'status_forcelist': [502, 503, 504],
+    'timeout': [10, 120],  # (connect, read) в секундах, если вызывающий код не задал свой
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """requests.Session с таймаутом по умолчанию для всех запросов."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        return super().request(method, url, **kwargs)
+
+
+def _host_key(url):
+    parsed = urlparse(url)
+    scheme = (parsed.scheme or 'http').lower()
+    port = parsed.port or (443 if scheme == 'https' else 80)
+    return scheme, (parsed.hostname or '').lower(), port
+
+
+def _settings_for(host):
+    http_cfg = CONFIG.get('http', {}) or {}
+    settings = dict(_DEFAULTS)
+    settings.update({k: v for k, v in http_cfg.items() if k != 'hosts'})
+    settings.update((http_cfg.get('hosts', {}) or {}).get(host, {}) or {})
+    return settings
+
+
+def new_session(url, **overrides):
+    """
+    Создает новую сессию с пулом keep-alive соединений, повторами и таймаутом по умолчанию.
+
+    :param url: str, любой URL целевого хоста (по нему выбираются настройки из CONFIG['http']['hosts'])
+    :param overrides: переопределения настроек для этой сессии (например, retries=0)
+    :return: PooledSession
+    """
+    settings = _settings_for(_host_key(url)[1])
+    settings.update(overrides)
+    retry = Retry(
+        total=int(settings['retries']),
+        backoff_factor=float(settings['backoff_factor']),
+        status_forcelist=list(settings['status_forcelist']),
+        # POST (загрузка вложений) не повторяется автоматически: тело запроса может быть потоком
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=int(settings['pool_connections']),
+        pool_maxsize=int(settings['pool_maxsize']),
+        max_retries=retry,
+    )
+    session = PooledSession(timeout=tuple(settings['timeout']))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(url):
+    """Возвращает общую для процесса сессию для хоста из url (создается при первом обращении)."""
+    key = _host_key(url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = new_session(url)
+            _sessions[key] = session
+        return session
+
+
+def request(method, url, **kwargs):
+    """Аналог requests.request через общую сессию хоста."""
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    """Аналог requests.get через общую сессию хоста."""
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Аналог requests.post через общую сессию хоста."""
+    return request('POST', url, **kwargs)
+
+
+def close_all():
+    """Закрывает все общие сессии (например, при остановке процесса)."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()